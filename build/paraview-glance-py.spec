@@ -19,7 +19,8 @@ a = Analysis([os.path.join('..', entry_point)],
              pathex=[repo_dir],
              binaries=[],
              datas=[(os.path.join('..', 'dist'), 'www')],
-             hiddenimports=[],
+             # algorithms of the registry are imported by name
+             hiddenimports=['hello_world'],
              hookspath=['./build/'],
              runtime_hooks=[],
              excludes=[],
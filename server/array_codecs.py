@@ -0,0 +1,93 @@
+import zlib
+
+import numpy as np
+
+# arrays smaller than this are never compressed
+COMPRESS_MIN_BYTES = 1 * 2**20
+
+# elements per contiguous block sampled when choosing a codec
+SAMPLE_BLOCK = 4096
+SAMPLE_BLOCKS = 16
+
+# use rle when fewer than this fraction of sampled neighbours differ
+RLE_MAX_CHANGE_RATE = 1 / 32
+# use zlib when the sampled bytes have fewer bits of entropy per byte
+ZLIB_MAX_ENTROPY = 6.0
+
+def rle_encode(data, dtype):
+    '''Run-length encodes the elements of a byte buffer.
+
+    Output is the uint32 run lengths followed by the run values, both
+    little-endian.
+    '''
+    arr = np.frombuffer(data, dtype=dtype)
+    if arr.size == 0:
+        return b''
+    starts = np.flatnonzero(arr[1:] != arr[:-1]) + 1
+    starts = np.concatenate(([0], starts))
+    lengths = np.diff(np.append(starts, arr.size)).astype('<u4')
+    values = arr[starts].astype(np.dtype(dtype).newbyteorder('<'), copy=False)
+    return lengths.tobytes() + values.tobytes()
+
+def rle_decode(data, dtype):
+    dtype = np.dtype(dtype).newbyteorder('<')
+    runs = len(data) // (4 + dtype.itemsize)
+    lengths = np.frombuffer(data, dtype='<u4', count=runs)
+    values = np.frombuffer(data, dtype=dtype, offset=4 * runs)
+    return np.repeat(values, lengths)
+
+_encoders = {
+    # passed through; helper.attachment_bytes copies it if wslink needs bytes
+    'none': lambda data, dtype: data,
+    'zlib': lambda data, dtype: zlib.compress(data, 1),
+    'rle': rle_encode,
+}
+
+_decoders = {
+    'none': lambda data, dtype: data,
+    'zlib': lambda data, dtype: zlib.decompress(data),
+    'rle': rle_decode,
+}
+
+CODECS = tuple(_encoders.keys())
+
+def encode(codec, data, dtype):
+    '''Encodes a byte buffer holding elements of dtype.'''
+    return _encoders[codec](data, dtype)
+
+def decode(codec, data, dtype):
+    '''Decodes a buffer produced by encode() back into bytes or an array.'''
+    return _decoders[codec](data, dtype)
+
+def _sample_blocks(arr):
+    flat = arr.ravel()
+    step = max(flat.size // SAMPLE_BLOCKS, SAMPLE_BLOCK)
+    return [flat[start:start+SAMPLE_BLOCK]
+            for start in range(0, flat.size, step)][:SAMPLE_BLOCKS]
+
+def byte_entropy(arr):
+    '''Shannon entropy, in bits per byte, of an array's bytes.'''
+    counts = np.bincount(np.ascontiguousarray(arr).view(np.uint8).ravel(),
+                         minlength=256)
+    p = counts[counts > 0] / counts.sum()
+    return float(-(p * np.log2(p)).sum())
+
+def choose_codec(arr, accepted, min_bytes=COMPRESS_MIN_BYTES):
+    '''Picks a codec for arr among the accepted ones.
+
+    Only a few contiguous blocks of the array are inspected: long runs of
+    equal integers (labelmaps) use rle, low-entropy data uses zlib and
+    anything else, e.g. noisy float images, is sent as is.
+    '''
+    if arr.nbytes < min_bytes or not accepted:
+        return 'none'
+
+    blocks = _sample_blocks(arr)
+    if 'rle' in accepted and arr.dtype.kind in 'biu':
+        changes = sum(np.count_nonzero(b[1:] != b[:-1]) for b in blocks)
+        if changes < RLE_MAX_CHANGE_RATE * sum(b.size for b in blocks):
+            return 'rle'
+    if 'zlib' in accepted:
+        if byte_entropy(np.concatenate(blocks)) < ZLIB_MAX_ENTROPY:
+            return 'zlib'
+    return 'none'
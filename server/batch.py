@@ -0,0 +1,236 @@
+'''Runs an algorithm headlessly over image/labelmap pairs read from disk.
+
+Cases are listed in a CSV file with image and labelmap columns, and an
+optional name column; relative paths are relative to the CSV file.
+The image and labelmap are given as the algorithm's first two source
+parameters, and other parameters default to those of get_parameters:
+
+    $ python batch.py cases.csv -o out/ -p median_filter_radius=1 -j 4
+
+Each case is run in a pool of worker processes, with the same algorithm
+code as the server. Outputs are written to the output
+directory, along with each case's log and a CSV of per-case timings and
+peak memory (timings.csv by default).
+'''
+import os
+import io
+import re
+import csv
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+import multiprocessing
+
+from helper import Api
+from jobs import JobRunner, configure_itk_threads
+from registry import registry
+
+# seconds between two memory samples of a running case
+MEMORY_SAMPLE_INTERVAL = 0.01
+
+def default_parameters(algorithm=None):
+    return {p['name']: p.get('default', None)
+            for p in registry.get(algorithm).parameters()
+            if p['type'] != 'source'}
+
+def source_parameters(algorithm=None):
+    return [p['name'] for p in registry.get(algorithm).parameters()
+            if p['type'] == 'source']
+
+def parse_parameter(text):
+    '''Parses name=value, the value being JSON or else a string.'''
+    name, _, value = text.partition('=')
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+def read_cases(path):
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='') as f:
+        cases = []
+        for i, row in enumerate(csv.DictReader(f)):
+            image = os.path.join(base, row['image'])
+            name = row.get('name') or os.path.splitext(
+                    os.path.basename(image))[0] or str(i)
+            cases.append({
+                'name': name,
+                'image': image,
+                'labelmap': os.path.join(base, row['labelmap']),
+            })
+        return cases
+
+def rss_bytes():
+    '''Resident memory of this process, or None if unknown.'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+class PeakMemory(object):
+    '''Samples the resident memory of the process from a thread.'''
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = rss_bytes()
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        rss = rss_bytes()
+        if rss is not None and self.peak is not None:
+            self.peak = max(self.peak, rss)
+
+def output_filename(output_dir, case_name, dataset_name, ext):
+    slug = re.sub(r'[^0-9A-Za-z]+', '_', dataset_name).strip('_').lower()
+    return os.path.join(output_dir, '{}_{}{}'.format(case_name, slug, ext))
+
+# state of a worker process
+_worker = {}
+
+def init_worker(threads, algorithm, algorithms_dirs):
+    configure_itk_threads(threads)
+    registry.load(algorithms_dirs)
+    _worker['api'] = Api()
+    _worker['algorithm'] = registry.get(algorithm).load()(_worker['api'])
+    _worker['sources'] = source_parameters(algorithm)
+    _worker['runner'] = JobRunner(max_threads=threads)
+    _worker['cases'] = 0
+
+def run_case(case, params, output_dir, ext):
+    '''Runs one case. Returns its row of the timings CSV.'''
+    import itk
+
+    api = _worker['api']
+    row = {
+        'case': case['name'],
+        'status': 'ok',
+        'error': '',
+        'pid': os.getpid(),
+        # the first case of a worker also loads the ITK filters
+        'first_in_worker': _worker['cases'] == 0,
+    }
+    _worker['cases'] += 1
+
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log), PeakMemory() as memory:
+            start = time.perf_counter()
+            image = itk.imread(case['image'])
+            labelmap = itk.imread(case['labelmap'])
+            row['read_s'] = time.perf_counter() - start
+
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            image_param, labelmap_param = _worker['sources'][:2]
+            case_params = dict(params, **{image_param: image,
+                                          labelmap_param: labelmap})
+            results, job = _worker['runner'].run_now(
+                    _worker['algorithm'].run, case_params)
+            row['run_s'] = time.perf_counter() - wall
+            row['cpu_s'] = time.process_time() - cpu
+            for stage, stage_wall, _, _ in job.timings:
+                row['stage_{}_s'.format(stage.replace(' ', '_'))] = stage_wall
+
+            start = time.perf_counter()
+            for dataset in results['datasets']:
+                itk.imwrite(dataset['dataset'], output_filename(
+                        output_dir, case['name'], dataset['name'], ext))
+            row['write_s'] = time.perf_counter() - start
+        if memory.peak is not None:
+            row['peak_rss_mb'] = memory.peak / 2**20
+    except Exception as e:
+        row['status'] = 'error'
+        row['error'] = str(e)
+    finally:
+        # stage results are not shared between cases
+        api.stages.clear()
+        log_file = os.path.join(output_dir, case['name'] + '.log')
+        with open(log_file, 'w') as f:
+            f.write(log.getvalue())
+    return row
+
+def write_timings(path, rows):
+    fields = ['case', 'status', 'error', 'pid', 'first_in_worker',
+              'read_s', 'run_s', 'cpu_s', 'write_s', 'peak_rss_mb']
+    for row in rows:
+        fields += [k for k in row if k not in fields]
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Runs an algorithm over image/labelmap pairs.')
+    parser.add_argument('cases',
+                        help='CSV file with image, labelmap and name columns')
+    parser.add_argument('-o', '--output-dir', default='batch-output',
+                        help='Directory for outputs, logs and timings')
+    parser.add_argument('-p', '--param', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='Algorithm parameter, may be repeated')
+    parser.add_argument('-a', '--algorithm', default=None,
+                        help='Name of the algorithm; defaults to the '
+                             'default algorithm of the server')
+    parser.add_argument('--algorithms-dir', action='append', default=[],
+                        help='Directory of algorithm descriptions (*.json) '
+                             'and modules, may be repeated')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of worker processes')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='ITK threads per worker; defaults to the CPUs '
+                             'divided among the workers')
+    parser.add_argument('--output-ext', default='.nrrd',
+                        help='File extension, and so format, of outputs')
+    parser.add_argument('--timings', default=None,
+                        help='Timings CSV; defaults to timings.csv in the '
+                             'output directory')
+    args = parser.parse_args()
+
+    registry.load(args.algorithms_dir)
+    params = default_parameters(args.algorithm)
+    params.update(parse_parameter(p) for p in args.param)
+    cases = read_cases(args.cases)
+    jobs = max(1, min(args.jobs, len(cases)))
+    threads = args.threads or max(1, (os.cpu_count() or 1) // jobs)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # worker threads do not survive a fork, so start fresh interpreters
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(jobs, init_worker,
+                      (threads, args.algorithm, args.algorithms_dir)) as pool:
+        pending = [pool.apply_async(run_case, (case, params, args.output_dir,
+                                               args.output_ext))
+                   for case in cases]
+        rows = []
+        for case, result in zip(cases, pending):
+            row = result.get()
+            rows.append(row)
+            if row['status'] == 'ok':
+                summary = '{:.2f} s'.format(row['run_s'])
+            else:
+                summary = (row['error'].splitlines() or [''])[0]
+            print('{}: {} {}'.format(case['name'], row['status'], summary))
+
+    timings = args.timings or os.path.join(args.output_dir, 'timings.csv')
+    write_timings(timings, rows)
+    print('Timings written to', timings)
+    failed = sum(row['status'] != 'ok' for row in rows)
+    sys.exit(1 if failed else 0)
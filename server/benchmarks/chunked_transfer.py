@@ -0,0 +1,66 @@
+'''Round-trips a volume larger than the maximum attachment size.
+
+Run from the server/ directory:
+
+    $ python benchmarks/chunked_transfer.py --size 256 --max-chunk-size 4
+
+The volume is uploaded as a ChunkedArrayBuffer the way the client sends
+it, reassembled by vtk_to_itk_image, then serialized back and reassembled
+again from the result chunks.
+'''
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import itk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chunking import join_chunks
+from helper import serialize_result
+from transformers import vtk_to_itk_image
+from local_session import LocalSession
+from synthetic import client_upload
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help='Edge length of the cubic test volume')
+    parser.add_argument('-m', '--max-chunk-size', type=int, default=4,
+                        help='Maximum attachment size in MB')
+    args = parser.parse_args()
+
+    chunk_size = args.max_chunk_size * 2**20
+    arr = np.random.default_rng(0).integers(
+            -1000, 3000, (args.size,) * 3).astype(np.int16)
+    assert arr.nbytes > chunk_size, 'volume must exceed the chunk size'
+
+    # instantiate the ITK templates before timing
+    vtk_to_itk_image(None, client_upload(arr[:1, :1, :1], chunk_size))
+
+    upload = client_upload(arr, chunk_size)
+    assert all(len(c) <= chunk_size for c in upload['pointData']['values']['chunks'])
+
+    start = time.perf_counter()
+    image = vtk_to_itk_image(None, upload)
+    decode_time = time.perf_counter() - start
+    assert np.array_equal(itk.GetArrayViewFromImage(image), arr)
+
+    sink = LocalSession(chunk_size=chunk_size)
+    start = time.perf_counter()
+    result = serialize_result(sink, {'dataset': image})
+    encode_time = time.perf_counter() - start
+
+    values = result['data']['dataset']['pointData']['values']
+    assert values['classType'] == 'ChunkedArrayBuffer'
+    assert all(len(a) <= chunk_size for a in sink.attachments)
+    chunks = [sink.attachments[i] for i in values['chunks']]
+    roundtrip = join_chunks(chunks, values['dataType'], values['byteLength'])
+    assert np.array_equal(roundtrip.reshape(arr.shape), arr)
+
+    print('volume MB:   {:.1f}'.format(arr.nbytes / 2**20))
+    print('chunks:      {}'.format(len(chunks)))
+    print('decode MB/s: {:.1f}'.format(arr.nbytes / decode_time / 2**20))
+    print('encode MB/s: {:.1f}'.format(arr.nbytes / encode_time / 2**20))
@@ -0,0 +1,63 @@
+'''Compression ratio and throughput of each attachment codec.
+
+Run from the server/ directory:
+
+    $ python benchmarks/codecs.py --size 128
+'''
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from array_codecs import CODECS, choose_codec, encode, decode
+
+def synthetic_arrays(size):
+    rng = np.random.default_rng(0)
+    shape = (size,) * 3
+    z, y, x = np.ogrid[:size, :size, :size]
+    sphere = (z - size / 2) ** 2 + (y - size / 2) ** 2 + (x - size / 2) ** 2
+
+    labelmap = np.zeros(shape, dtype=np.uint8)
+    labelmap[sphere < (size / 4) ** 2] = 1
+
+    ct = (1000 * np.exp(-sphere / size ** 2) +
+          rng.normal(0, 5, shape)).astype(np.int16)
+
+    noise = rng.random(shape, dtype=np.float32)
+
+    return [('labelmap uint8', labelmap), ('CT int16', ct),
+            ('noise float32', noise)]
+
+def throughput(nbytes, seconds):
+    return nbytes / max(seconds, 1e-9) / 2**20
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', type=int, default=128,
+                        help='Edge length of the cubic test volumes')
+    args = parser.parse_args()
+
+    print('{:<16} {:<6} {:>8} {:>12} {:>12}'.format(
+        'array', 'codec', 'ratio', 'enc MB/s', 'dec MB/s'))
+    for name, arr in synthetic_arrays(args.size):
+        data = memoryview(arr).cast('B')
+        for codec in CODECS:
+            start = time.perf_counter()
+            encoded = encode(codec, data, arr.dtype)
+            encode_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            decoded = decode(codec, encoded, arr.dtype)
+            decode_time = time.perf_counter() - start
+
+            assert np.array_equal(
+                    np.frombuffer(decoded, dtype=arr.dtype), arr.ravel())
+            print('{:<16} {:<6} {:>8.1f} {:>12.1f} {:>12.1f}'.format(
+                name, codec, arr.nbytes / max(len(encoded), 1),
+                throughput(arr.nbytes, encode_time),
+                throughput(arr.nbytes, decode_time)))
+        print('{:<16} chosen: {}'.format(name, choose_codec(arr, CODECS)))
@@ -0,0 +1,52 @@
+'''Compares vtk.js typed array decoding throughput.
+
+Run from the server/ directory:
+
+    $ python benchmarks/decode.py --size 64
+'''
+import os
+import sys
+import struct
+import timeit
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import JS_TO_NUMPY_DTYPE, _vtkjs_type_convert
+
+def struct_type_convert(blob, jstype):
+    '''The previous struct.unpack based decoder, kept for comparison.'''
+    dtype = JS_TO_NUMPY_DTYPE[jstype]
+    fmt = dtype.char
+    full_fmt = '<{0}{1}'.format(int(len(blob) / dtype.itemsize), fmt)
+    return np.array(struct.unpack(full_fmt, blob), dtype=dtype)
+
+def throughput(fn, blob, jstype, repeat):
+    seconds = min(timeit.repeat(lambda: fn(blob, jstype), number=1,
+                                repeat=repeat))
+    return len(blob) / seconds / 2**20
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', type=int, default=64,
+                        help='Edge length of the cubic test volume')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of timing repetitions')
+    args = parser.parse_args()
+
+    count = args.size ** 3
+    print('{:<14} {:>10} {:>14} {:>14}'.format(
+        'type', 'MB', 'struct MB/s', 'frombuffer MB/s'))
+    for jstype, dtype in JS_TO_NUMPY_DTYPE.items():
+        blob = np.arange(count).astype(dtype).tobytes()
+
+        # both paths must agree
+        assert np.array_equal(struct_type_convert(blob, jstype),
+                              _vtkjs_type_convert(blob, jstype))
+
+        old = throughput(struct_type_convert, blob, jstype, args.repeat)
+        new = throughput(_vtkjs_type_convert, blob, jstype, args.repeat)
+        print('{:<14} {:>10.1f} {:>14.1f} {:>14.1f}'.format(
+            jstype, len(blob) / 2**20, old, new))
@@ -0,0 +1,178 @@
+'''Load test of concurrent sessions, with the algorithm running in the
+server process or in a pool of worker processes.
+
+Run from the server/ directory:
+
+    $ python benchmarks/load_test.py --clients 8 --requests 4 --workers 4
+
+The simulated clients share one AlgorithmApi, as the connections of a
+wslink server do, and are told apart by their client ids. Each calls run
+through the RPC layer and waits for its result before sending its next
+request. Stage caches are disabled, so that every request runs the whole
+pipeline.
+'''
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import eventloop
+from helper import client_context
+from jobs import DEFAULT_MAX_JOBS
+from registry import AlgorithmApi
+from workers import WorkerPool
+from synthetic import synthetic_case
+
+class SharedSession(object):
+    '''Delivers the results published by a shared api to their clients.'''
+
+    def __init__(self, api):
+        self.api = api
+        self.attachments = 0
+        # deferredId -> client waiting for the result
+        self._pending = {}
+        api.publish = self.publish
+        api.addAttachment = self.add_attachment
+
+    def add_attachment(self, payload):
+        self.attachments += 1
+        return self.attachments
+
+    def run(self, client, params):
+        with client_context(client.id):
+            reply = self.api.run({'uid': None, 'data': params})
+        self._pending[reply['deferredId']] = client
+
+    def publish(self, topic, data, client_id=None):
+        if topic != 'defer.results' or data.get('partial'):
+            return
+        client = self._pending.pop(data['deferredId'])
+        # results are only sent to the client that asked for them
+        assert client_id == client.id
+        client.receive(data)
+
+class SimulatedClient(object):
+    '''Sends requests one after the other, as one wslink client.'''
+
+    def __init__(self, session, client_id, params, requests, done):
+        self.session = session
+        self.id = client_id
+        self.params = params
+        self.requests = requests
+        self.done = done
+        self.latencies = []
+        self.errors = 0
+        self._sent = None
+
+    def send(self):
+        self._sent = time.perf_counter()
+        self.session.run(self, self.params)
+
+    def receive(self, data):
+        self.latencies.append(time.perf_counter() - self._sent)
+        if data.get('error'):
+            self.errors += 1
+            print('error:', data['error'])
+        if len(self.latencies) < self.requests:
+            self.send()
+        else:
+            self.done(self)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--clients', type=int, default=8,
+                        help='Number of simulated clients')
+    parser.add_argument('-r', '--requests', type=int, default=4,
+                        help='Number of runs sent by each client')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='Number of worker processes; 0 runs the '
+                             'algorithm in this process')
+    parser.add_argument('-j', '--max-jobs', type=int, default=DEFAULT_MAX_JOBS,
+                        help='Number of runs allowed in parallel, as with '
+                             'the server\'s --max-jobs')
+    parser.add_argument('-s', '--size', type=int, default=96,
+                        help='Edge length of the cubic test volumes')
+    args = parser.parse_args()
+
+    threads = os.cpu_count() or 1
+    workers = None
+    if args.workers > 0:
+        workers = WorkerPool(args.workers,
+                             threads=max(1, threads // args.workers),
+                             stage_cache_size=0)
+
+    image, labelmap = synthetic_case(args.size, args.size // 4)
+    params = {
+        'input_image': image,
+        'input_labelmap': labelmap,
+        'median_filter_radius': 1,
+        'hole_fill_iterations': 3,
+        'invert': False,
+    }
+
+    # sized as by the server
+    max_jobs = args.max_jobs
+    if workers is not None:
+        max_jobs = max(max_jobs, args.workers)
+    api = AlgorithmApi(workers=workers, stage_cache_size=0,
+                       max_threads=threads, max_jobs=max_jobs)
+    session = SharedSession(api)
+    timing = {}
+
+    def run_clients(prefix, count, requests, then):
+        finished = []
+
+        def on_done(client):
+            finished.append(client)
+            if len(finished) == count:
+                if workers is not None:
+                    timing['sessions'] = sorted(
+                            w['sessions'] for w in workers.stats()['workers'])
+                for c in finished:
+                    api.onClose(c.id)
+                then(finished)
+
+        for i in range(count):
+            SimulatedClient(session, '{}{}'.format(prefix, i), params,
+                            requests, on_done).send()
+
+    def measure(warmup_clients):
+        assert all(client.errors == 0 for client in warmup_clients)
+        timing['start'] = time.perf_counter()
+        run_clients('client', args.clients, args.requests, report)
+
+    def report(clients):
+        timing['elapsed'] = time.perf_counter() - timing['start']
+        timing['clients'] = clients
+        loop.stop()
+
+    # results are delivered on the event loop, as in the server
+    loop = eventloop.install()
+    # load ITK, and start the workers, before timing
+    loop.call_soon(run_clients, 'warmup',
+                   max(1, min(args.clients, args.workers)), 1, measure)
+    loop.run_forever()
+    if workers is not None:
+        workers.stop()
+
+    clients = timing['clients']
+    elapsed = timing['elapsed']
+    latencies = np.concatenate([client.latencies for client in clients])
+    errors = sum(client.errors for client in clients)
+    assert errors == 0
+    print('mode:            {}'.format(
+            '{} workers'.format(args.workers) if workers else 'in-process'))
+    print('clients:         {}'.format(args.clients))
+    print('max jobs:        {}'.format(max_jobs))
+    if workers is not None:
+        # clients are spread over the workers, not all sent to one
+        assert timing['sessions'][-1] <= -(-args.clients // args.workers)
+        print('worker sessions: {}'.format(timing['sessions']))
+    print('requests:        {}'.format(latencies.size))
+    print('throughput /s:   {:.2f}'.format(latencies.size / elapsed))
+    print('latency p50 s:   {:.3f}'.format(np.percentile(latencies, 50)))
+    print('latency p99 s:   {:.3f}'.format(np.percentile(latencies, 99)))
@@ -0,0 +1,50 @@
+'''A stand-in for the wslink session, for benchmarks run without a browser.'''
+import inspect
+
+from helper import serialize_result
+from registry import AlgorithmApi
+
+class LocalSession(AlgorithmApi):
+    '''Calls the RPC handlers of an AlgorithmApi directly.
+
+    Arguments are wrapped the way the client sends them, attachments and
+    published messages are kept, and deferred calls run to completion in
+    the calling thread, so that no event loop is needed.
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.attachments = []
+        self.messages = []
+        # the job of the last deferred call
+        self.last_job = None
+        # newer wslink versions set these per instance until linked
+        self.addAttachment = self.add_attachment
+        self.publish = self.publish_message
+
+    def add_attachment(self, payload):
+        self.attachments.append(payload)
+        return len(self.attachments) - 1
+
+    def publish_message(self, topic, data, client_id=None):
+        self.messages.append((topic, data))
+
+    def defer_call(self, fn, args, kwargs, call=None):
+        with call.phase('handler'):
+            retval, self.last_job = self._jobs.run_now(fn, self, *args,
+                                                       **kwargs)
+        with call.phase('serialize'):
+            return serialize_result(self, retval)
+
+    def call(self, rpc, *args):
+        '''Calls the handler registered as rpc with client-side arguments.'''
+        for name, fn in inspect.getmembers(type(self), callable):
+            uris = getattr(fn, '_wslinkuris', ())
+            if any(uri['uri'] == rpc for uri in uris):
+                return getattr(self, name)(*[{'uid': None, 'data': arg}
+                                             for arg in args])
+        raise Exception('Unknown RPC: {}'.format(rpc))
+
+    def clear(self):
+        self.attachments = []
+        self.messages = []
@@ -0,0 +1,59 @@
+'''Compares running the algorithm on the whole volume and in ROI mode.
+
+Run from the server/ directory:
+
+    $ python benchmarks/roi.py --size 256 --object 24
+'''
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import itk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helper import Api
+from hello_world import HelloWorld
+from synthetic import synthetic_case
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help='Edge length of the cubic test volume')
+    parser.add_argument('-o', '--object', type=int, default=24,
+                        help='Edge length of the segmented object')
+    args = parser.parse_args()
+
+    image, labelmap = synthetic_case(args.size, args.object)
+    params = {
+        'input_image': image,
+        'input_labelmap': labelmap,
+        'median_filter_radius': 2,
+        'hole_fill_iterations': 5,
+        'invert': False,
+        'roi_margin': args.object,
+    }
+
+    # load the ITK filters before timing
+    HelloWorld(Api(stage_cache_size=0)).run(dict(params, roi=True))
+
+    timings = {}
+    outputs = {}
+    for name, roi in (('full', False), ('roi', True)):
+        algorithm = HelloWorld(Api(stage_cache_size=0))
+        start = time.perf_counter()
+        result = algorithm.run(dict(params, roi=roi))
+        timings[name] = time.perf_counter() - start
+        outputs[name] = itk.GetArrayFromImage(result['datasets'][1]['dataset'])
+
+    full, roi = outputs['full'] > 0, outputs['roi'] > 0
+    dice = 2 * np.count_nonzero(full & roi) / (
+            np.count_nonzero(full) + np.count_nonzero(roi))
+    assert dice > 0.99
+
+    print('volume voxels:  {}'.format(full.size))
+    print('full volume s:  {:.3f}'.format(timings['full']))
+    print('ROI mode s:     {:.3f}'.format(timings['roi']))
+    print('dice:           {:.4f}'.format(dice))
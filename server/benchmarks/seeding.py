@@ -0,0 +1,74 @@
+'''Compares per-voxel AddSeed seeding with marker-image seeding.
+
+Run from the server/ directory:
+
+    $ python benchmarks/seeding.py --size 128 --brush 12
+'''
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import itk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hello_world import grow_from_seeds
+
+def add_seed_growing(image, LabelMapType, seed_indices, lower, upper,
+                     replace_value):
+    '''ConnectedThresholdImageFilter with one AddSeed call per voxel.'''
+    ImageType = type(image)
+    shape = itk.GetArrayViewFromImage(image).shape
+    zyx = np.unravel_index(seed_indices, shape)
+
+    connected = itk.ConnectedThresholdImageFilter[ImageType, LabelMapType].New(image)
+    connected.SetLower(int(lower))
+    connected.SetUpper(int(upper))
+    connected.SetReplaceValue(int(replace_value))
+    for z, y, x in zip(*zyx):
+        coord = itk.Index[3]()
+        coord[0] = int(x)
+        coord[1] = int(y)
+        coord[2] = int(z)
+        connected.AddSeed(coord)
+    connected.Update()
+    return connected.GetOutput()
+
+def brush_stroke(size, radius):
+    '''Flat indices of a thick diagonal stroke through a cubic volume.'''
+    z, y, x = np.ogrid[:size, :size, :size]
+    center = size // 2
+    dist2 = (z - center) ** 2 + (y - x) ** 2
+    return np.flatnonzero(np.broadcast_to(dist2 <= radius ** 2,
+                                          (size, size, size)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', type=int, default=128,
+                        help='Edge length of the cubic test volume')
+    parser.add_argument('-b', '--brush', type=int, default=12,
+                        help='Brush radius in voxels')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    arr = rng.normal(100, 20, (args.size,) * 3).clip(0, 255).astype(np.uint8)
+    image = itk.GetImageFromArray(arr)
+    LabelMapType = itk.Image[itk.UC, 3]
+    seeds = brush_stroke(args.size, args.brush)
+
+    timings = {}
+    outputs = {}
+    for name, fn in (('AddSeed', add_seed_growing),
+                     ('marker', grow_from_seeds)):
+        start = time.perf_counter()
+        output = fn(image, LabelMapType, seeds, 90, 140, 1)
+        timings[name] = time.perf_counter() - start
+        outputs[name] = itk.GetArrayFromImage(output)
+
+    assert np.array_equal(outputs['AddSeed'], outputs['marker'])
+
+    print('seeds:          {}'.format(seeds.size))
+    print('AddSeed loop s: {:.3f}'.format(timings['AddSeed']))
+    print('marker image s: {:.3f}'.format(timings['marker']))
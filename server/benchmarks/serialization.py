@@ -0,0 +1,122 @@
+'''Compares the JSONRecurser with the previous copying implementation.
+
+Run from the server/ directory:
+
+    $ python benchmarks/serialization.py --tubes 200 --points 500
+'''
+import os
+import sys
+import copy
+import timeit
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from serializable import _serializeRecurser, serialize
+import transformers # register our serializers
+
+class CopyingRecurser(object):
+    '''The previous JSONRecurser: copies every node, tries every tester.'''
+
+    def __init__(self, transformers):
+        self.transformers = transformers
+
+    def replace(self, key, value):
+        for transformer, tester in self.transformers:
+            flag = False
+            try:
+                flag = tester(key, value)
+            except Exception:
+                pass
+            if flag:
+                return transformer(key, value)
+        return value
+
+    def recurse(self, obj, extra_transformer=lambda k, v: v):
+        def replacer(key, value):
+            return extra_transformer(key, self.replace(key, value))
+        return self._recurse(replacer(None, obj), replacer)
+
+    def _recurse(self, obj, replacer):
+        try:
+            obj = copy.copy(obj)
+        except Exception:
+            pass
+        if type(obj) is dict:
+            for key in obj:
+                obj[key] = self._recurse(replacer(key, obj[key]), replacer)
+        elif type(obj) is list or type(obj) is tuple:
+            obj = type(obj)([self._recurse(replacer(i, v), replacer)
+                             for i, v in enumerate(obj)])
+        return obj
+
+def legacy_tester(fn, tester, types):
+    '''Folds a typed registration back into a single untyped tester.'''
+    def legacy(k, v):
+        if types is not None and not (
+                issubclass(type(v), types) if isinstance(types, tuple)
+                else types(type(v))):
+            # the old testers raised on the wrong types
+            raise TypeError()
+        return tester is None or tester(k, v)
+    return fn, legacy
+
+def tube_payload(tubes, points):
+    '''A vessel tree result as produced by the per-point tube serializer.'''
+    rng = np.random.default_rng(0)
+    return {
+        'tubes': [
+            {
+                'id': t,
+                'points': [
+                    {
+                        'point': list(rng.random(3)),
+                        'radius': float(rng.random()),
+                    }
+                    for _ in range(points)
+                ],
+                'color': [1.0, 0.0, 0.0, 1.0],
+                'parent': t - 1,
+            }
+            for t in range(tubes)
+        ],
+        'datasets': [
+            { 'name': 'Output labelmap',
+              'values': np.zeros(2**20, dtype=np.uint8) },
+        ],
+    }
+
+def attachment_replacer(key, value):
+    if isinstance(value, np.ndarray):
+        return { 'classType': 'ArrayBuffer', 'buffer': 0 }
+    return value
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--tubes', type=int, default=200,
+                        help='Number of tubes in the payload')
+    parser.add_argument('-p', '--points', type=int, default=500,
+                        help='Number of points per tube')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of timing repetitions')
+    args = parser.parse_args()
+
+    payload = tube_payload(args.tubes, args.points)
+    legacy = CopyingRecurser(
+            [legacy_tester(*t) for t in _serializeRecurser.transformers])
+
+    assert (legacy.recurse(payload, attachment_replacer) ==
+            serialize(payload, attachment_replacer))
+
+    def best(fn):
+        return min(timeit.repeat(lambda: fn(payload, attachment_replacer),
+                                 number=1, repeat=args.repeat))
+
+    old = best(legacy.recurse)
+    new = best(serialize)
+    print('tube points: {}'.format(args.tubes * args.points))
+    print('copying s:   {:.3f}'.format(old))
+    print('dispatch s:  {:.3f}'.format(new))
+    print('speedup:     {:.1f}x'.format(old / new))
@@ -0,0 +1,80 @@
+'''Measures peak memory while serializing an ITK image for the client.
+
+Run from the server/ directory:
+
+    $ python benchmarks/serialize_memory.py --size 256
+
+The attachment payloads are collected the way wslink's addAttachment holds
+them until they are sent. The ratio (image bytes + extra bytes allocated
+during serialization) / image bytes must stay under MAX_PEAK_RATIO, plus one
+copy of the image with wslink versions that only accept bytes attachments.
+'''
+import os
+import sys
+import argparse
+import tracemalloc
+
+import numpy as np
+import itk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helper import (attachment_payload, attachment_bytes,
+                    ATTACHMENTS_ACCEPT_BUFFERS)
+from serializable import serialize
+
+# bound of the peak/volume ratio when attachments are not copied
+MAX_PEAK_RATIO = 1.2
+
+def serialize_with_attachments(obj):
+    attachments = []
+
+    def attachment_replacer(key, value):
+        if isinstance(value, np.ndarray):
+            attachments.append(attachment_bytes(attachment_payload(value)))
+            return {
+                'classType': 'ArrayBuffer',
+                'dataType': str(value.dtype),
+                'buffer': len(attachments) - 1,
+            }
+        return value
+
+    return serialize(obj, attachment_replacer), attachments
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help='Edge length of the cubic test volume')
+    args = parser.parse_args()
+
+    shape = (args.size,) * 3
+    image = itk.GetImageFromArray(np.zeros(shape, dtype=np.int16))
+    labelmap = itk.GetImageFromArray(np.zeros(shape, dtype=np.uint8))
+    volume_bytes = np.prod(shape) * (2 + 1)
+
+    result = {
+        'datasets': [
+            { 'name': 'Output image', 'dataset': image },
+            { 'name': 'Output labelmap', 'dataset': labelmap },
+        ],
+    }
+
+    tracemalloc.start()
+    data, attachments = serialize_with_attachments(result)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # the ITK images must be kept alive by the pending attachments alone
+    del result, image, labelmap
+    assert sum(memoryview(a).nbytes for a in attachments) == volume_bytes
+
+    ratio = (volume_bytes + peak) / volume_bytes
+    max_ratio = MAX_PEAK_RATIO
+    if not ATTACHMENTS_ACCEPT_BUFFERS:
+        # attachments are copied into bytes for wslink
+        max_ratio += 1
+
+    print('volume MB:         {:.1f}'.format(volume_bytes / 2**20))
+    print('extra peak MB:     {:.1f}'.format(peak / 2**20))
+    print('peak/volume ratio: {:.3f} (max {:.1f})'.format(ratio, max_ratio))
+    assert ratio <= max_ratio, 'serialization copied the pixel buffers'
@@ -0,0 +1,275 @@
+'''Reproducible benchmarks of the server data path and algorithm.
+
+Run from the server/ directory:
+
+    $ python benchmarks/suite.py run -o results.json
+    $ python benchmarks/suite.py run -o quick.json --sizes 64 128 --repeat 3
+    $ python benchmarks/suite.py compare baseline.json results.json
+
+run generates a synthetic volume and painted labelmap for each size and
+dtype, and times each phase --repeat times:
+
+    decode            vtk_to_itk_image of the client's upload
+    serialize         serialize_result of an image, i.e. itk_to_vtk_image
+                      and its attachments
+    threshold search  choose_thresholds, from the label statistics
+    seeding           grow_from_seeds of the object label
+    run               the run RPC end to end, through a LocalSession, from
+                      the client's uploads to the serialized result
+    median, label statistics, growth, hole filling
+                      the stages of those run calls
+
+Results are written as JSON, along with the commit and environment they
+were measured on. compare reports the phases whose best time got slower
+than in the baseline by more than --threshold, and exits with 1 if any.
+'''
+import os
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import contextlib
+import subprocess
+
+import numpy as np
+import itk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hello_world import (HelloWorld, image_statistics, choose_thresholds,
+                         grow_from_seeds)
+from helper import serialize_result
+from transformers import vtk_to_itk_image
+from local_session import LocalSession
+from synthetic import (synthetic_volume, painted_labelmap, client_upload,
+                       DTYPES)
+
+SIZES = (64, 128, 256, 512)
+PHASES = ('decode', 'serialize', 'threshold search', 'seeding', 'run')
+# stages of the run calls reported as phases of their own
+RUN_STAGES = ('median', 'label statistics', 'growth', 'hole filling')
+
+# format version of the results file
+RESULTS_VERSION = 1
+
+def timed(fn):
+    start = time.perf_counter()
+    retval = fn()
+    return time.perf_counter() - start, retval
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+                ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'itk': itk.Version.GetITKVersion(),
+    }
+
+def run_parameters(image, labelmap):
+    params = {p['name']: p.get('default', None)
+              for p in HelloWorld.parameters() if p['type'] != 'source'}
+    params.update(input_image=image, input_labelmap=labelmap)
+    return params
+
+def run_call(session, params):
+    '''Calls run, returning the stage timings of its job.'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        session.call('run', params)
+    session.clear()
+    timings = {}
+    for stage, wall, _, _ in session.last_job.timings:
+        timings[stage] = timings.get(stage, 0) + wall
+    return timings
+
+def bench_case(size, dtype, phases, repeat):
+    '''Returns {phase: [seconds of each repetition]} for one volume.'''
+    arr = synthetic_volume(size, dtype)
+    arr_labelmap = painted_labelmap(size)
+    image = itk.GetImageFromArray(arr)
+    labelmap = itk.GetImageFromArray(arr_labelmap)
+    session = LocalSession(stage_cache_size=0)
+    times = {}
+
+    def add(phase, seconds):
+        times.setdefault(phase, []).append(seconds)
+
+    if 'decode' in phases:
+        upload = client_upload(arr)
+        for _ in range(repeat):
+            add('decode', timed(lambda: vtk_to_itk_image(None, upload))[0])
+
+    if 'serialize' in phases:
+        for _ in range(repeat):
+            add('serialize', timed(
+                    lambda: serialize_result(session, {'dataset': image}))[0])
+            session.clear()
+
+    image_min, image_max, stats, ids = image_statistics(image, labelmap)
+    low, high, _, _ = choose_thresholds(image_min, image_max, stats, ids)
+    if 'threshold search' in phases:
+        for _ in range(repeat):
+            add('threshold search', timed(lambda: choose_thresholds(
+                    image_min, image_max, stats, ids))[0])
+
+    if 'seeding' in phases:
+        seeds = stats[ids[1].item()]['indices']
+        for _ in range(repeat):
+            add('seeding', timed(lambda: grow_from_seeds(
+                    image, type(labelmap), seeds, low, high, int(ids[1])))[0])
+
+    if 'run' in phases:
+        params = run_parameters(client_upload(arr),
+                                client_upload(arr_labelmap))
+        for _ in range(repeat):
+            seconds, stages = timed(lambda: run_call(session, params))
+            add('run', seconds)
+            for stage in RUN_STAGES:
+                if stage in stages:
+                    add(stage, stages[stage])
+    return times
+
+def warm_up(dtypes):
+    '''Loads the ITK modules and filters of each dtype before timing.'''
+    for dtype in dtypes:
+        bench_case(32, dtype, PHASES, 1)
+
+def run(args):
+    results = {}
+    warm_up(args.dtypes)
+    for size in args.sizes:
+        for dtype in args.dtypes:
+            times = bench_case(size, dtype, args.phases, args.repeat)
+            for phase, seconds in times.items():
+                key = '{}/{}/{}'.format(phase, size, dtype)
+                results[key] = {
+                    'phase': phase,
+                    'size': size,
+                    'dtype': dtype,
+                    'voxels': size ** 3,
+                    'times': seconds,
+                    'best': min(seconds),
+                    'median': float(np.median(seconds)),
+                }
+                print('{:<40} {:10.6f} s'.format(key, min(seconds)))
+                sys.stdout.flush()
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'version': RESULTS_VERSION,
+            'created': datetime.datetime.now().isoformat(),
+            'commit': git_commit(),
+            'environment': environment(),
+            'config': {
+                'sizes': args.sizes,
+                'dtypes': args.dtypes,
+                'phases': args.phases,
+                'repeat': args.repeat,
+            },
+            'results': results,
+        }, f, indent=2)
+    print('Results written to', args.output)
+
+def compare(baseline, current, threshold, min_seconds):
+    '''Compares the best times of two results files.
+
+    Returns (rows, regressions), rows being (key, baseline seconds, current
+    seconds, relative change, status). A phase regresses if it is slower
+    by more than threshold and by more than min_seconds.
+    '''
+    rows = []
+    regressions = 0
+    base = baseline['results']
+    new = current['results']
+    for key in sorted(set(base) | set(new)):
+        if key not in new:
+            rows.append((key, base[key]['best'], None, None, 'missing'))
+            continue
+        if key not in base:
+            rows.append((key, None, new[key]['best'], None, 'new'))
+            continue
+        before, after = base[key]['best'], new[key]['best']
+        change = after / before - 1 if before > 0 else 0
+        status = 'ok'
+        if change > threshold and after - before > min_seconds:
+            status = 'REGRESSION'
+            regressions += 1
+        elif change < -threshold and before - after > min_seconds:
+            status = 'improved'
+        rows.append((key, before, after, change, status))
+    return rows, regressions
+
+def print_comparison(baseline, current, rows):
+    def seconds(value):
+        return '{:10.6f}'.format(value) if value is not None else ' ' * 10
+
+    print('baseline: {} ({})'.format(baseline.get('commit'),
+                                     baseline.get('created')))
+    print('current:  {} ({})'.format(current.get('commit'),
+                                     current.get('created')))
+    if baseline.get('environment') != current.get('environment'):
+        print('warning: measured in different environments')
+    print('{:<40} {:>10} {:>10} {:>8}  {}'.format(
+            'phase/size/dtype', 'base s', 'new s', 'change', 'status'))
+    for key, before, after, change, status in rows:
+        print('{:<40} {} {} {:>8}  {}'.format(
+                key, seconds(before), seconds(after),
+                '{:+.1%}'.format(change) if change is not None else '',
+                status))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmarks the server data path and algorithm.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='Runs the benchmarks')
+    run_parser.add_argument('-o', '--output', default='benchmark-results.json',
+                            help='JSON file the results are written to')
+    run_parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                            default=list(SIZES),
+                            help='Edge lengths of the cubic test volumes')
+    run_parser.add_argument('-d', '--dtypes', nargs='+', default=list(DTYPES),
+                            choices=DTYPES, help='Pixel types of the volumes')
+    run_parser.add_argument('-p', '--phases', nargs='+', default=list(PHASES),
+                            choices=PHASES, help='Phases to time')
+    run_parser.add_argument('-r', '--repeat', type=int, default=5,
+                            help='Number of times each phase is timed')
+
+    compare_parser = subparsers.add_parser(
+            'compare', help='Reports regressions between two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                                help='Relative slowdown reported as a '
+                                     'regression')
+    compare_parser.add_argument('--min-seconds', type=float, default=0.005,
+                                help='Slowdowns smaller than this are '
+                                     'ignored as noise')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        rows, regressions = compare(baseline, current, args.threshold,
+                                    args.min_seconds)
+        print_comparison(baseline, current, rows)
+        print('{} regression(s) above {:.0%}'.format(regressions,
+                                                     args.threshold))
+        sys.exit(1 if regressions else 0)
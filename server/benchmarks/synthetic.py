@@ -0,0 +1,77 @@
+'''Synthetic volumes and painted labelmaps shared by the benchmarks.'''
+import numpy as np
+import itk
+
+from chunking import split_chunks
+
+# pixel types of the generated volumes, all wrapped by ITK
+DTYPES = ('uint8', 'int16', 'uint16', 'float32')
+
+# intensities are scaled up for wider pixel types, as in CT or MR volumes
+INTENSITY_SCALE = {'uint8': 1, 'int16': 16, 'uint16': 16, 'float32': 1}
+
+NUMPY_TO_JS_TYPE = {
+    'int8': 'Int8Array',
+    'uint8': 'Uint8Array',
+    'int16': 'Int16Array',
+    'uint16': 'Uint16Array',
+    'int32': 'Int32Array',
+    'uint32': 'Uint32Array',
+    'float32': 'Float32Array',
+    'float64': 'Float64Array',
+}
+
+def synthetic_volume(size, dtype='uint8', object_size=None, seed=0):
+    '''A noisy cubic volume with one bright cube in its center.'''
+    object_size = object_size or size // 4
+    scale = INTENSITY_SCALE[dtype]
+    rng = np.random.default_rng(seed)
+    arr = rng.normal(60, 10, (size,) * 3).clip(0, 120)
+    center = size // 2
+    low, high = center - object_size // 2, center + object_size // 2
+    arr[low:high, low:high, low:high] += 120
+    return (arr * scale).astype(dtype)
+
+def painted_labelmap(size, object_size=None):
+    '''Strokes painted inside (label 1) and outside (label 2) the cube.'''
+    object_size = object_size or size // 4
+    center = size // 2
+    low = center - object_size // 2
+    labelmap = np.zeros((size,) * 3, dtype=np.uint8)
+    labelmap[center, center-3:center+3, center-3:center+3] = 1
+    labelmap[center, low-6:low-2, center-2:center+2] = 2
+    return labelmap
+
+def synthetic_case(size, object_size=None, dtype='uint8'):
+    '''(image, labelmap) as ITK images.'''
+    return (itk.GetImageFromArray(synthetic_volume(size, dtype, object_size)),
+            itk.GetImageFromArray(painted_labelmap(size, object_size)))
+
+def client_upload(arr, chunk_size=None):
+    '''The vtkImageData a client sends for arr.
+
+    Values are given as the bytes of the attachment wslink receives, or as
+    a ChunkedArrayBuffer if arr is larger than chunk_size.
+    '''
+    depth, height, width = arr.shape
+    if chunk_size is not None and arr.nbytes > chunk_size:
+        values = {
+            'classType': 'ChunkedArrayBuffer',
+            'byteLength': arr.nbytes,
+            'chunks': [bytes(c) for c in split_chunks(arr, chunk_size)],
+        }
+    else:
+        values = np.ascontiguousarray(arr).tobytes()
+    return {
+        'vtkClass': 'vtkImageData',
+        'origin': [0, 0, 0],
+        'spacing': [1, 1, 1],
+        'direction': [1, 0, 0, 0, 1, 0, 0, 0, 1],
+        'extent': [0, width - 1, 0, height - 1, 0, depth - 1],
+        'pointData': {
+            'vtkClass': 'vtkDataArray',
+            'dataType': NUMPY_TO_JS_TYPE[str(arr.dtype)],
+            'numberOfComponents': 1,
+            'values': values,
+        },
+    }
@@ -0,0 +1,107 @@
+'''Checks and times the vectorized threshold search against the original
+per-threshold loop from HelloWorld.segment.
+
+Run from the server/ directory:
+
+    $ python benchmarks/threshold_search.py --sizes 10000 100000 1000000
+'''
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hello_world import search_low_threshold, search_high_threshold
+
+def loop_search(objectV, others, threshLow, threshHigh):
+    '''The original threshold search, kept as the reference.'''
+    objectMean = np.mean(objectV)
+    objectCount = objectV.size
+    bestLowErr = 1
+    bestHighErr = 1
+    for iV in others:
+        iMean = np.mean(iV)
+        iCount = iV.size
+        if iMean < objectMean:
+            for t in range(int(threshLow),int(objectMean)):
+                iErr = np.count_nonzero(iV>t) / iCount
+                objectErr = np.count_nonzero(objectV<t) / objectCount
+                if iErr + objectErr < bestLowErr:
+                    threshLow = t
+                    bestLowErr = iErr + objectErr
+        else:
+            iters = range(int(objectMean),int(threshHigh))
+            for t in iters[::-1]:
+                iErr = np.count_nonzero(iV<t) / iCount
+                objectErr = np.count_nonzero(objectV>t) / objectCount
+                if iErr + objectErr < bestHighErr:
+                    threshHigh = t
+                    bestHighErr = iErr + objectErr
+    return threshLow, threshHigh, bestLowErr, bestHighErr
+
+def vectorized_search(objectV, others, threshLow, threshHigh):
+    objectMean = np.mean(objectV)
+    objectSorted = np.sort(objectV, axis=None)
+    bestLowErr = 1
+    bestHighErr = 1
+    for iV in others:
+        iSorted = np.sort(iV, axis=None)
+        if np.mean(iV) < objectMean:
+            t, err = search_low_threshold(
+                    objectSorted, iSorted, int(threshLow), int(objectMean))
+            if err < bestLowErr:
+                threshLow = t
+                bestLowErr = err
+        else:
+            t, err = search_high_threshold(
+                    objectSorted, iSorted, int(objectMean), int(threshHigh))
+            if err < bestHighErr:
+                threshHigh = t
+                bestHighErr = err
+    return threshLow, threshHigh, bestLowErr, bestHighErr
+
+def synthetic_labels(size, dtype, rng):
+    '''Object voxels around 400 with darker and brighter background labels.'''
+    def label(mean, std):
+        return rng.normal(mean, std, size).astype(dtype)
+    return label(400, 150), [label(-200, 300), label(1200, 400), label(0, 100)]
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='Number of voxels per painted label')
+    parser.add_argument('--skip-loop', action='store_true',
+                        help='Only time the vectorized search')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print('{:<10} {:<8} {:>10} {:>14}'.format(
+        'voxels', 'dtype', 'loop s', 'vectorized s'))
+    for size in args.sizes:
+        for dtype in (np.int16, np.float32):
+            objectV, others = synthetic_labels(size, dtype, rng)
+            objectMean = np.mean(objectV)
+            objectStd = np.std(objectV)
+            threshLow = int(objectMean - 4 * objectStd)
+            threshHigh = int(objectMean + 4 * objectStd)
+
+            new, new_time = timed(vectorized_search,
+                                  objectV, others, threshLow, threshHigh)
+            old_time = float('nan')
+            if not args.skip_loop:
+                old, old_time = timed(loop_search,
+                                      objectV, others, threshLow, threshHigh)
+                # thresholds and errors must be bit-identical
+                assert old == new, (old, new)
+
+            print('{:<10} {:<8} {:>10.3f} {:>14.4f}'.format(
+                size, np.dtype(dtype).name, old_time, new_time))
@@ -0,0 +1,89 @@
+'''Compares per-point and columnar encodings of tube results.
+
+Run from the server/ directory:
+
+    $ python benchmarks/tubes.py --tubes 200 --points 500
+'''
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import itk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import serialize_tube_group
+
+def per_point_encoding(tubes):
+    '''The previous serialize_tube output, one dict per point.'''
+    result = []
+    for tube in tubes:
+        tube_points = []
+        for i in range(tube.GetNumberOfPoints()):
+            point = tube.GetPoint(i)
+            tube_points.append({
+                'point': list(point.GetPositionInObjectSpace()),
+                'radius': point.GetRadiusInObjectSpace(),
+            })
+        result.append({
+            'id': tube.GetId(),
+            'points': tube_points,
+            'color': list(tube.GetProperty().GetColor()),
+            'parent': tube.GetParentId(),
+        })
+    return json.dumps(result).encode()
+
+def columnar_encoding(tubes):
+    '''JSON header plus binary attachments, as sent by the rpc decorator.'''
+    group = serialize_tube_group(None, tubes)
+    attachments = []
+    for key in ('offsets', 'positions', 'radii'):
+        attachments.append(group[key].tobytes())
+        group[key] = len(attachments) - 1
+    return json.dumps(group).encode(), attachments
+
+def make_tubes(count, points):
+    rng = np.random.default_rng(0)
+    TubeType = itk.TubeSpatialObject[3]
+    PointType = itk.TubeSpatialObjectPoint[3]
+    tubes = []
+    for t in range(count):
+        tube_points = []
+        for position in rng.random((points, 3)) * 100:
+            point = PointType()
+            point.SetPositionInObjectSpace([float(x) for x in position])
+            point.SetRadiusInObjectSpace(float(rng.random()))
+            tube_points.append(point)
+        tube = TubeType.New()
+        tube.SetPoints(tube_points)
+        tube.SetId(t)
+        tubes.append(tube)
+    return tubes
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--tubes', type=int, default=200,
+                        help='Number of tubes')
+    parser.add_argument('-p', '--points', type=int, default=500,
+                        help='Number of points per tube')
+    args = parser.parse_args()
+
+    tubes = make_tubes(args.tubes, args.points)
+
+    old, old_time = timed(per_point_encoding, tubes)
+    (header, attachments), new_time = timed(columnar_encoding, tubes)
+    new_size = len(header) + sum(len(a) for a in attachments)
+
+    print('points:             {}'.format(args.tubes * args.points))
+    print('per-point  MB / s:  {:.2f} / {:.3f}'.format(
+        len(old) / 2**20, old_time))
+    print('columnar   MB / s:  {:.2f} / {:.3f}'.format(
+        new_size / 2**20, new_time))
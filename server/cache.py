@@ -0,0 +1,71 @@
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''A least-recently-used cache bounded by a total byte budget.
+
+    Each entry is stored with its size in bytes. Inserting an entry evicts
+    the least recently used entries until the cache fits its budget again.
+    Entries larger than the whole budget are not cached. on_evict(key,
+    value), if given, is called for each entry evicted to make room.
+    '''
+
+    def __init__(self, max_bytes, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+        self.misses += 1
+        return default
+
+    def put(self, key, value, nbytes):
+        '''Caches value under key. Returns True if the value was cached.'''
+        self.pop(key)
+        if nbytes > self.max_bytes:
+            return False
+
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            evicted_key, (evicted, evicted_bytes) = \
+                    self._entries.popitem(last=False)
+            self.nbytes -= evicted_bytes
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(evicted_key, evicted)
+        return True
+
+    def pop(self, key, default=None):
+        if key in self._entries:
+            value, nbytes = self._entries.pop(key)
+            self.nbytes -= nbytes
+            return value
+        return default
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {
+            'count': len(self._entries),
+            'bytes': self.nbytes,
+            'maxBytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,38 @@
+import numpy as np
+
+# default maximum size of one binary attachment
+DEFAULT_CHUNK_SIZE = 16 * 2**20
+
+def is_chunked(o):
+    return type(o) is dict and o.get('classType') == 'ChunkedArrayBuffer'
+
+def split_chunks(arr, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Splits an array into zero-copy byte views of at most chunk_size.
+
+    Chunk boundaries fall on element boundaries.
+    '''
+    data = memoryview(np.ascontiguousarray(arr)).cast('B')
+    step = max(chunk_size - chunk_size % arr.itemsize, arr.itemsize)
+    return [data[start:start+step] for start in range(0, len(data), step)]
+
+def join_chunks(chunks, dtype, byte_length=None):
+    '''Reassembles byte chunks into one preallocated array of dtype.
+
+    chunks may be a generator, so each chunk can be produced (e.g. decoded)
+    only when it is copied in.
+    '''
+    if byte_length is None:
+        chunks = list(chunks)
+        byte_length = sum(memoryview(c).nbytes for c in chunks)
+    dtype = np.dtype(dtype)
+    assert byte_length % dtype.itemsize == 0
+
+    arr = np.empty(byte_length // dtype.itemsize, dtype=dtype)
+    out = arr.view(np.uint8)
+    offset = 0
+    for chunk in chunks:
+        chunk = np.frombuffer(chunk, dtype=np.uint8)
+        out[offset:offset+chunk.size] = chunk
+        offset += chunk.size
+    assert offset == byte_length
+    return arr
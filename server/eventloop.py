@@ -0,0 +1,38 @@
+import asyncio
+import functools
+
+# the asyncio loop wslink serves clients from, see install()
+_loop = None
+
+def install():
+    '''Creates the event loop wslink runs, and hands calls over to it.
+
+    Called in the main thread before starting the wslink server, which runs
+    the current event loop of the thread.
+    '''
+    global _loop
+    _loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_loop)
+    return _loop
+
+def call_from_thread(fn, *args, **kwargs):
+    '''Calls fn(*args, **kwargs) from the event loop's thread.
+
+    wslink must only be called from that thread, e.g. to publish. Without
+    an installed loop, e.g. in benchmarks, fn is called right away.
+    '''
+    if _loop is None:
+        fn(*args, **kwargs)
+    else:
+        _loop.call_soon_threadsafe(functools.partial(fn, *args, **kwargs))
+
+def call_later(delay, fn, *args):
+    '''Calls fn(*args) from the event loop's thread after delay seconds.
+
+    Must be called from that thread. Returns a handle whose cancel()
+    unschedules the call, or None without an installed loop, in which case
+    fn is not called.
+    '''
+    if _loop is None:
+        return None
+    return _loop.call_later(delay, fn, *args)
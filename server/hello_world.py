@@ -1,17 +1,281 @@
 import sys
-import itk
 import random
 
 import numpy as np
 
-from helper import Api, rpc, forward_stdout
+from jobs import (observe_filter, check_cancelled, request_threads,
+                  timed_stage, JobCancelled, DEFAULT_MAX_THREADS)
+from label_statistics import compute_label_statistics, label_ids
+from registry import Algorithm
+from startup import profile as startup_profile
 
-class AlgorithmApi(Api):
-    def __init__(self):
-        super().__init__()
+def _threshold_errors(below_sorted, above_sorted, thresholds):
+    '''Misclassification rates for each candidate threshold t.
 
-    @rpc('get_parameters')
-    def params(self):
+    Returns the fraction of below_sorted values greater than t plus the
+    fraction of above_sorted values less than t. Both inputs must be sorted.
+    '''
+    below_err = below_sorted.size - np.searchsorted(
+            below_sorted, thresholds, side='right')
+    above_err = np.searchsorted(above_sorted, thresholds, side='left')
+    return below_err / below_sorted.size + above_err / above_sorted.size
+
+def search_low_threshold(object_sorted, other_sorted, start, stop):
+    '''Finds the lower object threshold in range(start, stop).
+
+    other_sorted holds the sorted values of a label darker than the object.
+    Returns (threshold, error) for the smallest threshold with minimal
+    error, or (None, inf) if the range is empty.
+    '''
+    thresholds = np.arange(start, stop)
+    if thresholds.size == 0:
+        return None, float('inf')
+    errors = _threshold_errors(other_sorted, object_sorted, thresholds)
+    best = np.argmin(errors)
+    return int(thresholds[best]), float(errors[best])
+
+def search_high_threshold(object_sorted, other_sorted, start, stop):
+    '''Finds the upper object threshold in range(start, stop).
+
+    other_sorted holds the sorted values of a label brighter than the object.
+    Returns (threshold, error) for the largest threshold with minimal
+    error, or (None, inf) if the range is empty.
+    '''
+    thresholds = np.arange(start, stop)
+    if thresholds.size == 0:
+        return None, float('inf')
+    errors = _threshold_errors(object_sorted, other_sorted, thresholds)
+    best = errors.size - 1 - np.argmin(errors[::-1])
+    return int(thresholds[best]), float(errors[best])
+
+def choose_thresholds(imageMin, imageMax, stats, ids):
+    '''Picks the threshold range of the object, the first painted label.
+
+    Starts from the object mean +/- 4 std, then moves each bound to best
+    separate the object from the darker and brighter painted labels.
+    Returns (low, high, low error, high error).
+    '''
+    objectStats = stats[ids[1].item()]
+    objectMean = objectStats['mean']
+    objectStd = objectStats['std']
+    objectSorted = objectStats['sorted_values']
+
+    threshLow = int(objectMean - 4 * objectStd)
+    if threshLow < imageMin:
+        threshLow = imageMin
+    threshHigh = int(objectMean + 4 * objectStd)
+    if threshHigh > imageMax:
+        threshHigh = imageMax
+
+    bestLowErr = 1
+    bestHighErr = 1
+    for i in ids[2:]:
+        iMean = stats[i.item()]['mean']
+        iSorted = stats[i.item()]['sorted_values']
+        if iMean < objectMean:
+            t, err = search_low_threshold(
+                    objectSorted, iSorted, int(threshLow), int(objectMean))
+            if err < bestLowErr:
+                threshLow = t
+                bestLowErr = err
+        else:
+            t, err = search_high_threshold(
+                    objectSorted, iSorted, int(objectMean), int(threshHigh))
+            if err < bestHighErr:
+                threshHigh = t
+                bestHighErr = err
+    return threshLow, threshHigh, bestLowErr, bestHighErr
+
+def grow_from_seeds(image, LabelMapType, seed_indices, lower, upper,
+                    replace_value):
+    '''Grows the regions of image within [lower, upper] containing seeds.
+
+    Equivalent to a ConnectedThresholdImageFilter with one seed per entry
+    of seed_indices (flat C-order voxel indices), but the seeds are given
+    as a marker image to a reconstruction by dilation, so there is no
+    per-seed Python call.
+    '''
+    import itk
+
+    ImageType = type(image)
+
+    threshold = itk.BinaryThresholdImageFilter[ImageType, LabelMapType].New(image)
+    observe_filter(threshold, 'Thresholding')
+    threshold.SetLowerThreshold(int(lower))
+    threshold.SetUpperThreshold(int(upper))
+    threshold.SetInsideValue(int(replace_value))
+    threshold.SetOutsideValue(0)
+    threshold.Update()
+    mask = threshold.GetOutput()
+
+    # seeds outside the threshold range are dropped, as they would not grow
+    arr_mask = itk.GetArrayViewFromImage(mask)
+    arr_marker = np.zeros_like(arr_mask)
+    arr_marker.ravel()[seed_indices] = arr_mask.ravel()[seed_indices]
+    marker = itk.GetImageFromArray(arr_marker)
+    marker.CopyInformation(mask)
+
+    reconstruction = itk.ReconstructionByDilationImageFilter[
+            LabelMapType, LabelMapType].New()
+    observe_filter(reconstruction, 'Object growing')
+    reconstruction.SetMarkerImage(marker)
+    reconstruction.SetMaskImage(mask)
+    reconstruction.Update()
+    return reconstruction.GetOutput()
+
+def median_filter(image, radius):
+    import itk
+
+    ImageType = type(image)
+    median = itk.MedianImageFilter[ImageType, ImageType].New()
+    observe_filter(median, 'Filtering')
+    median.SetInput(image)
+    median.SetRadius(radius)
+    median.Update()
+    return median.GetOutput()
+
+def image_statistics(image, labelmap):
+    '''Returns (min, max, label statistics, label ids) of image.'''
+    import itk
+
+    arr_image = itk.GetArrayViewFromImage(image)
+    arr_labelmap = itk.GetArrayViewFromImage(labelmap)
+    stats = compute_label_statistics(arr_labelmap, arr_image)
+    return (int(np.amin(arr_image)), int(np.amax(arr_image)),
+            stats, label_ids(arr_labelmap, stats))
+
+# pixel types whose filters are instantiated at startup
+PREWARM_IMAGE_PIXEL_TYPES = ('UC', 'SS', 'US', 'F')
+PREWARM_LABELMAP_PIXEL_TYPES = ('UC',)
+
+# downsampling factors of the preview levels, coarsest first
+PREVIEW_FACTORS = (4, 2)
+# preview levels are skipped once an axis would be shorter than this
+MIN_PREVIEW_SIZE = 16
+
+def preview_levels(shape):
+    '''Downsampling factors worth previewing an image of shape at.'''
+    return [f for f in PREVIEW_FACTORS if min(shape) // f >= MIN_PREVIEW_SIZE]
+
+def shrink_image(image, factor):
+    '''Downsamples image by averaging blocks of factor voxels per axis.'''
+    import itk
+
+    ImageType = type(image)
+    shrink = itk.BinShrinkImageFilter[ImageType, ImageType].New(image)
+    observe_filter(shrink, 'Shrinking')
+    shrink.SetShrinkFactors(factor)
+    shrink.Update()
+    return shrink.GetOutput()
+
+def shrink_labelmap(labelmap, reference, factor):
+    '''Downsamples labelmap onto reference, a shrink_image() output.
+
+    Each voxel takes the object label, the smallest painted one, if its
+    block has any, or else the largest label of its block, so that thin
+    brush strokes are not lost.
+    '''
+    import itk
+
+    arr = itk.GetArrayViewFromImage(labelmap)
+    shape = itk.GetArrayViewFromImage(reference).shape
+    blocks = arr[tuple(slice(0, n * factor) for n in shape)]
+    blocks = blocks.reshape(sum(((n, factor) for n in shape), ()))
+    axes = tuple(range(1, 2 * len(shape), 2))
+    arr_small = blocks.max(axis=axes)
+    painted = arr[arr != 0]
+    if painted.size:
+        object_id = painted.min()
+        arr_small[(blocks == object_id).any(axis=axes)] = object_id
+    small = itk.GetImageFromArray(np.ascontiguousarray(arr_small))
+    small.CopyInformation(reference)
+    return small
+
+def label_bounding_box(arr_labelmap, pad):
+    '''Bounding box of the painted voxels of a labelmap, grown by pad.
+
+    Returns (start, size) in ITK (x, y, z) index order, clipped to the
+    labelmap, or None if nothing is painted.
+    '''
+    start = []
+    size = []
+    for axis in range(arr_labelmap.ndim):
+        others = tuple(a for a in range(arr_labelmap.ndim) if a != axis)
+        painted = np.flatnonzero(arr_labelmap.any(axis=others))
+        if painted.size == 0:
+            return None
+        low = max(int(painted[0]) - pad, 0)
+        high = min(int(painted[-1]) + pad + 1, arr_labelmap.shape[axis])
+        start.append(low)
+        size.append(high - low)
+    return tuple(start[::-1]), tuple(size[::-1])
+
+def extract_region(image, start, size):
+    '''Crops image to a region, keeping its physical position.'''
+    import itk
+
+    ImageType = type(image)
+    region = itk.ImageRegion[image.GetImageDimension()]()
+    region.SetIndex(start)
+    region.SetSize(size)
+    roi = itk.RegionOfInterestImageFilter[ImageType, ImageType].New(image)
+    roi.SetRegionOfInterest(region)
+    roi.Update()
+    return roi.GetOutput()
+
+def paste_region(region_image, reference, start, keep_reference=False):
+    '''Pastes region_image at index start of an image like reference.
+
+    Voxels outside of the region are zero, or those of reference with
+    keep_reference=True.
+    '''
+    import itk
+
+    arr_region = itk.GetArrayViewFromImage(region_image)
+    if keep_reference:
+        arr = itk.GetArrayFromImage(reference)
+    else:
+        arr = np.zeros(itk.GetArrayViewFromImage(reference).shape,
+                       dtype=arr_region.dtype)
+    region = tuple(slice(s, s + n)
+                   for s, n in zip(start[::-1], arr_region.shape))
+    arr[region] = arr_region
+    pasted = itk.GetImageFromArray(arr)
+    pasted.CopyInformation(reference)
+    return pasted
+
+class HelloWorld(Algorithm):
+    @classmethod
+    def prewarm(cls):
+        import itk
+
+        for pixel in PREWARM_IMAGE_PIXEL_TYPES:
+            for label_pixel in PREWARM_LABELMAP_PIXEL_TYPES:
+                with startup_profile.timed('image types {} {}'.format(
+                        pixel, label_pixel)):
+                    ImageType = itk.Image[getattr(itk, pixel), 3]
+                    LabelMapType = itk.Image[getattr(itk, label_pixel), 3]
+                filters = [
+                    ('MedianImageFilter', (ImageType, ImageType)),
+                    ('BinShrinkImageFilter', (ImageType, ImageType)),
+                    ('RegionOfInterestImageFilter', (ImageType, ImageType)),
+                    ('BinaryThresholdImageFilter', (ImageType, LabelMapType)),
+                    ('ReconstructionByDilationImageFilter',
+                     (LabelMapType, LabelMapType)),
+                    ('VotingBinaryIterativeHoleFillingImageFilter',
+                     (LabelMapType,)),
+                ]
+                for name, types in filters:
+                    with startup_profile.timed('{} {} {}'.format(
+                            name, pixel, label_pixel)):
+                        try:
+                            getattr(itk, name)[types].New()
+                        except TypeError:
+                            # not wrapped for these pixel types
+                            pass
+
+    @classmethod
+    def parameters(cls):
         return [
             {
                 'name': 'input_image',
@@ -45,113 +309,164 @@ class AlgorithmApi(Api):
                 'type': 'bool',
                 'default': False,
             },
+            {
+                'name': 'preview',
+                'label': 'Preview at lower resolutions first',
+                'type': 'bool',
+                'default': False,
+            },
+            {
+                'name': 'roi',
+                'label': 'Process painted region only '
+                         '(image is left unfiltered outside of it)',
+                'type': 'bool',
+                'default': False,
+            },
+            {
+                'name': 'roi_margin',
+                'label': 'Region margin (voxels)',
+                'type': 'range',
+                'range': [0, 100],
+                'step': 1,
+                'default': 20,
+            },
+            {
+                'name': 'roi_crop_output',
+                'label': 'Return region only',
+                'type': 'bool',
+                'default': False,
+            },
+            {
+                'name': 'threads',
+                'label': 'Threads (0 = automatic)',
+                'type': 'range',
+                'range': [0, DEFAULT_MAX_THREADS],
+                'step': 1,
+                'default': 0,
+            },
         ]
 
-    @rpc('run')
-    @forward_stdout
     def run(self, params):
+        import itk
+
         input_image = params['input_image']
         labelmap = params['input_labelmap']
 
         if not input_image or not labelmap:
             raise Exception('No input image or labelmap!')
 
-        ImageType = type(input_image)
+        request_threads(params.get('threads', 0))
+        stages = self.stages
 
-        LabelMapType = type(labelmap)
+        # in ROI mode, the pipeline runs on the painted region only. Unless
+        # only the region is returned, the output image is the input image
+        # with the filtered region pasted in, and the output labelmap is
+        # empty outside of the region.
+        roi = None
+        if params.get('roi'):
+            roi = label_bounding_box(
+                    itk.GetArrayViewFromImage(labelmap),
+                    params['median_filter_radius'] + params.get('roi_margin', 0))
+        if roi is not None:
+            full_image = input_image
+            full_labelmap = labelmap
+            region = {'start': roi[0], 'size': roi[1]}
+            input_image = stages.run('roi', extract_region, (input_image,), region)
+            labelmap = stages.run('roi', extract_region, (labelmap,), region)
 
-        print("Filtering...")
-        median_filter = itk.MedianImageFilter[ImageType, ImageType].New()
-        median_filter.SetInput(input_image)
-        median_filter.SetRadius(params['median_filter_radius'])
-        median_filter.Update()
-        out_image = median_filter.GetOutput()
+        levels = []
+        if params.get('preview'):
+            levels = preview_levels(itk.GetArrayViewFromImage(input_image).shape)
+        for factor in levels:
+            check_cancelled()
+            print("Previewing at 1/{} resolution...".format(factor))
+            small_image = stages.run('shrink', shrink_image, (input_image,),
+                                     {'factor': factor})
+            small_labelmap = stages.run('shrink', shrink_labelmap,
+                                        (labelmap, small_image),
+                                        {'factor': factor})
+            try:
+                preview = self.segment(
+                        small_image, small_labelmap, params,
+                        params['median_filter_radius'] // factor)
+            except JobCancelled:
+                raise
+            except Exception as e:
+                print("Preview failed:", e)
+                continue
+            self.publish_partial(self.results(*preview), level=factor)
 
-        arr_image = itk.GetArrayFromImage(out_image)
-        arr_labelmap = itk.GetArrayFromImage(labelmap)
+        out_image, out_labelmap = self.segment(
+                input_image, labelmap, params, params['median_filter_radius'])
 
-        imageMin = int(np.amin(arr_image))
-        imageMax = int(np.amax(arr_image))
+        if roi is not None and not params.get('roi_crop_output'):
+            out_image = paste_region(out_image, full_image, roi[0],
+                                     keep_reference=True)
+            out_labelmap = paste_region(out_labelmap, full_labelmap, roi[0])
+
+        print("Done!")
 
-        ids = np.unique(arr_labelmap)
+        return self.results(out_image, out_labelmap)
+
+    def segment(self, input_image, labelmap, params, median_radius):
+        '''Runs the pipeline. Returns (filtered image, output labelmap).'''
+        import itk
+
+        LabelMapType = type(labelmap)
+        stages = self.stages
+
+        print("Filtering...")
+        out_image = stages.run(
+                'median', median_filter, (input_image,),
+                {'radius': median_radius})
+
+        imageMin, imageMax, stats, ids = stages.run(
+                'label statistics', image_statistics, (out_image, labelmap))
         if ids.size < 3:
             raise Exception("ERROR: Please paint at least two colors.")
 
+        check_cancelled()
         print("Segmenting...")
         objectId = ids[1]
-        notObjectIds = ids[2:]
-
-        objectIndx = np.argwhere(arr_labelmap == objectId)
-        objectV = arr_image[objectIndx[:,0],objectIndx[:,1],objectIndx[:,2]]
-        objectMean = np.mean(objectV)
-        objectStd = np.std(objectV)
-        objectCount = objectV.size
-
-        threshLow = int(objectMean - 4 * objectStd)
-        if threshLow < imageMin:
-            threshLow = imageMin
-        threshHigh = int(objectMean + 4 * objectStd)
-        if threshHigh > imageMax:
-            threshHigh = imageMax
-
-        bestLowErr = 1
-        bestHighErr = 1
-        for i in notObjectIds:
-            indx = np.argwhere(arr_labelmap == i)
-            iV = arr_image[indx[:,0],indx[:,1],indx[:,2]]
-            iMean = np.mean(iV)
-            iCount = iV.size
-            if iMean < objectMean:
-                for t in range(int(threshLow),int(objectMean)):
-                    iErr = np.count_nonzero(iV>t) / iCount
-                    objectErr = np.count_nonzero(objectV<t) / objectCount
-                    if iErr + objectErr < bestLowErr:
-                        threshLow = t
-                        bestLowErr = iErr + objectErr
-            else:
-                iters = range(int(objectMean),int(threshHigh))
-                for t in iters[::-1]:
-                    iErr = np.count_nonzero(iV<t) / iCount
-                    objectErr = np.count_nonzero(objectV>t) / objectCount
-                    if iErr + objectErr < bestHighErr:
-                        threshHigh = t
-                        bestHighErr = iErr + objectErr
+        objectStats = stats[objectId.item()]
+        threshLow, threshHigh, bestLowErr, bestHighErr = choose_thresholds(
+                imageMin, imageMax, stats, ids)
         print("Object range = ", threshLow, " - ", threshHigh)
         print("   Errors = ", bestLowErr, " - ", bestHighErr)
 
-        connected = itk.ConnectedThresholdImageFilter[ImageType, LabelMapType].New(out_image)
-        connected.SetLower(int(threshLow))
-        connected.SetUpper(int(threshHigh))
-        connected.SetReplaceValue(int(objectId))
-        for i in range(0,objectIndx[:,0].size):
-            coord = itk.Index[3]()
-            coord[0] = int(objectIndx[i,0])
-            coord[1] = int(objectIndx[i,1])
-            coord[2] = int(objectIndx[i,2])
-            connected.AddSeed(coord)
         print("Object growing...")
-        connected.Update()
+        grown = stages.run(
+                'growth',
+                lambda image, labelmap, **thresholds: grow_from_seeds(
+                    image, LabelMapType, objectStats['indices'], **thresholds),
+                (out_image, labelmap),
+                {'lower': threshLow, 'upper': threshHigh,
+                 'replace_value': int(objectId)})
 
-        holeFill = itk.VotingBinaryIterativeHoleFillingImageFilter[LabelMapType].New(connected.GetOutput())
+        holeFill = itk.VotingBinaryIterativeHoleFillingImageFilter[LabelMapType].New(grown)
         holeFill.SetForegroundValue(int(objectId))
         holeFill.SetBackgroundValue(0)
         holeFill.SetMaximumNumberOfIterations(params['hole_fill_iterations'])
+        observe_filter(holeFill, 'Hole filling')
         print("Hole filling...")
-        holeFill.Update()
+        with timed_stage('hole filling'):
+            holeFill.Update()
 
         out_labelmap = holeFill.GetOutput()
 
         if params['invert']:
             invert = itk.InverIntensityImageFilter[LabelMapType].New(holeFill.GetOutput())
             invert.SetMaximum(int(objectId))
+            observe_filter(invert, 'Inverting')
             print("Inverting...")
-            invert.Update()
+            with timed_stage('invert'):
+                invert.Update()
             out_labelmapimage = invert.GetOuput()
             out_labelmap = invert.GetOutput()
 
-        print("Done!")
-
+        return out_image, out_labelmap
 
+    def results(self, out_image, out_labelmap):
         return {
             'datasets': [
                 {
@@ -1,138 +1,502 @@
-import sys
-import weakref
-import uuid
+import atexit
+import functools
+import threading
+import traceback
+import importlib.util
+from contextlib import contextmanager
 
 import numpy
 import wslink
 from wslink.websocket import LinkProtocol
 
+import eventloop
+from array_codecs import CODECS, choose_codec, encode
+from cache import LRUCache
+from chunking import split_chunks, DEFAULT_CHUNK_SIZE
+from spill import SpillDirectory, DEFAULT_SPILL_SIZE
+from object_store import ObjectStore, DEFAULT_OBJECT_STORE_SIZE
+from jobs import JobRunner, current_job, DEFAULT_MAX_JOBS, DEFAULT_MAX_THREADS
+from stages import StageCache, DEFAULT_STAGE_CACHE_SIZE
 from serializable import serialize, unserialize
+from metrics import metrics as rpc_metrics, phase, current_call
+from startup import profile as startup_profile
+from streams import LogChannel, stdout_router, metrics as log_metrics
 import transformers # register our serializers/unserializers
+from transformers import object_nbytes
 
-class WsOut(object):
-    def __init__(self, protocol):
-        self.protocol = protocol
+_local = threading.local()
 
-    def write(self, b):
-        self.protocol.publish('streams.stdout', b)
+def current_client_id():
+    '''The wslink id of the client whose call the calling thread handles.
 
-    def flush(self):
-        pass
+    Set by the rpc decorator, and kept for the jobs and published results
+    of deferred calls. None outside of a call, or if wslink does not
+    identify clients.
+    '''
+    return getattr(_local, 'client_id', None)
 
-class NetworkTee(object):
-    def __init__(self, netout):
-        self.netout = netout
-        self.stdout = sys.stdout
+@contextmanager
+def client_context(client_id):
+    '''Makes client_id the current client of the calling thread.'''
+    previous = current_client_id()
+    _local.client_id = client_id
+    try:
+        yield
+    finally:
+        _local.client_id = previous
 
-    def write(self, b):
-        self.netout.write(b)
-        self.stdout.write(b)
+def forward_stdout(fn):
+    '''Forwards the handler's stdout to the client on streams.stdout.
 
-    def flush(self):
-        self.netout.flush()
-        self.stdout.flush()
+    Output is routed per thread and published in batches, only to the
+    calling client, so concurrent handlers do not see each other's output.
+    '''
+    @functools.wraps(fn)
+    def handler(self, *args, **kwargs):
+        router = stdout_router()
+        channel = LogChannel(functools.partial(
+                self.publish, client_id=current_client_id()))
+        previous = router.route(channel)
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            router.route(previous)
+            channel.close()
+    return handler
 
+# The Twisted versions of wslink hand attachments to autobahn's sendMessage,
+# which only accepts bytes. The aiohttp versions (with wslink.backends) pack
+# them with msgpack, which accepts any buffer.
+ATTACHMENTS_ACCEPT_BUFFERS = importlib.util.find_spec('wslink.backends') \
+        is not None
 
-def forward_stdout(fn):
-    def handler(self, *args, **kwargs):
-        wsout = WsOut(self)
-        tee = NetworkTee(wsout)
-        sys.stdout = tee
+def attachment_payload(arr):
+    '''Returns a byte view of an array, to be encoded into an attachment.
 
-        ret = fn(self, *args, **kwargs)
+    Contiguous arrays (such as views of ITK pixel buffers) are not copied.
+    '''
+    return memoryview(numpy.ascontiguousarray(arr)).cast('B')
 
-        sys.stdout = tee.stdout
-        return ret
-    return handler
+def attachment_bytes(payload):
+    '''Converts an encoded payload to what addAttachment accepts.
 
-def rpc(name):
-    def wrapper(fn):
-        def handler(self, *args, **kwargs):
-            args, kwargs = self.rewrite_args(args, kwargs)
+    Buffers are passed as is when wslink accepts them. Otherwise they are
+    copied into bytes here, at the protocol boundary, so the attachments
+    pending in wslink then hold a copy of each array.
+    '''
+    if ATTACHMENTS_ACCEPT_BUFFERS or isinstance(payload, bytes):
+        return payload
+    return bytes(payload)
+
+def serialize_result(api, retval):
+    '''Serializes an RPC return value, sending ndarrays as attachments.
 
-            retval = fn(self, *args, **kwargs)
-            uid = self.get_persistent_uid(retval)
+    Arrays larger than api.chunk_size are sent as a ChunkedArrayBuffer: a
+    manifest listing one attachment per chunk. Each array is encoded with
+    a codec chosen among the ones the current client accepts.
+    '''
+    uid = api.acquire_uid(retval)
 
+    def attachment_replacer(key, value):
+        if isinstance(value, numpy.ndarray):
+            codec = choose_codec(value, api.client_codecs())
 
-            def attachment_replacer(key, value):
-                if type(value) is numpy.ndarray:
-                    return {
-                        'classType': 'ArrayBuffer',
-                        'dataType': str(value.dtype),
-                        'buffer': self.addAttachment(value.tobytes()),
-                    }
-                return value
+            def attach(data):
+                with phase('encode'):
+                    payload = encode(codec, data, value.dtype)
+                call = current_call()
+                if call is not None:
+                    call.attachment(memoryview(payload).nbytes)
+                return api.addAttachment(attachment_bytes(payload))
 
+            if value.nbytes > api.chunk_size:
+                return {
+                    'classType': 'ChunkedArrayBuffer',
+                    'dataType': str(value.dtype),
+                    'codec': codec,
+                    'byteLength': value.nbytes,
+                    'chunks': [attach(chunk)
+                               for chunk in split_chunks(value, api.chunk_size)],
+                }
             return {
-                'uid': uid,
-                'data': serialize(retval, attachment_replacer)
+                'classType': 'ArrayBuffer',
+                'dataType': str(value.dtype),
+                'codec': codec,
+                'buffer': attach(attachment_payload(value)),
             }
+        return value
+
+    return {
+        'uid': uid,
+        'data': serialize(retval, attachment_replacer)
+    }
+
+def rpc(name, deferred=False):
+    '''Registers an RPC endpoint.
+
+    With deferred=True, the endpoint runs in the job pool. The call returns
+    a deferredId right away and the result is published on defer.results.
+
+    Each call is measured (see metrics.py): the time spent in each phase,
+    the bytes received and sent as attachments, and the growth of the
+    process' peak memory.
+
+    The handler runs with the calling client as current_client_id().
+    '''
+    def wrapper(fn):
+        @functools.wraps(fn)
+        def handler(self, *args, **kwargs):
+            call = rpc_metrics.start(name)
+            call.bytes_in = object_nbytes((args, kwargs))
+            try:
+                with client_context(self.active_client_id()), call.active():
+                    with call.phase('rewrite_args'):
+                        args, kwargs = self.rewrite_args(args, kwargs)
+
+                    if deferred:
+                        # finished once the result is published
+                        return self.defer_call(fn, args, kwargs, call)
+
+                    with call.phase('handler'):
+                        retval = fn(self, *args, **kwargs)
+                    with call.phase('serialize'):
+                        result = serialize_result(self, retval)
+            except Exception:
+                call.finish(error=True)
+                raise
+            call.finish()
+            return result
 
         return wslink.register(name)(handler)
 
     return wrapper
 
+# default byte budget of the content-addressed dataset cache
+DEFAULT_DATASET_CACHE_SIZE = 2 * 2**30
+
 class Api(LinkProtocol):
-    def __init__(self):
+    def __init__(self, dataset_cache_size=DEFAULT_DATASET_CACHE_SIZE,
+                 max_jobs=DEFAULT_MAX_JOBS, chunk_size=DEFAULT_CHUNK_SIZE,
+                 stage_cache_size=DEFAULT_STAGE_CACHE_SIZE,
+                 max_threads=DEFAULT_MAX_THREADS,
+                 object_store_size=DEFAULT_OBJECT_STORE_SIZE,
+                 spill_dir=None, spill_size=DEFAULT_SPILL_SIZE):
         super().__init__()
-        self._cache = {}
-        self._persistent_objects = weakref.WeakKeyDictionary()
+        self.chunk_size = chunk_size
+        # codecs each client can decode, by client id, see set_codecs
+        self._codecs = {}
+        self._jobs = JobRunner(max_jobs, self._publish_job_progress,
+                               max_threads)
+        # volumes evicted from memory are kept on disk if spill_dir is set
+        self._spill = None
+        if spill_dir:
+            self._spill = SpillDirectory(spill_dir, spill_size)
+            atexit.register(self._spill.clear)
+        # objects referenced by the clients through uids
+        self._objects = ObjectStore(object_store_size, self._spill)
+        # uids of the references held by each client, by client id
+        self._client_refs = {}
+        # uploaded datasets, keyed by the uploading client and its hash of
+        # pixels + geometry, see dataset_key
+        self._dataset_cache = LRUCache(dataset_cache_size,
+                                       on_evict=self._spill_dataset)
+        # memoized intermediate results of algorithm pipelines
+        self.stages = StageCache(stage_cache_size)
+
+    def active_client_id(self):
+        '''The wslink id of the client whose RPC is being dispatched.
+
+        wslink records it on its web app before calling a handler. Falls
+        back to current_client_id(), e.g. for calls made without wslink.
+        '''
+        handler = getattr(self.publish, '__self__', None)
+        web_app = getattr(handler, 'web_app', None)
+        client_id = getattr(web_app, 'last_active_client_id', None)
+        if client_id is None:
+            return current_client_id()
+        return client_id
+
+    def client_codecs(self):
+        '''Codecs the current client can decode.'''
+        return self._codecs.get(current_client_id(), ())
 
     def rewrite_args(self, args, kwargs):
         new_args = []
         new_kwargs = {}
 
         for arg in args:
-            if type(arg) is dict:
-                uid = arg['uid']
-                data = arg['data']
-                if uid is None:
-                    new_args.append(unserialize(data))
-                else:
-                    new_args.append(self._cache.get(uid, None))
-            else:
-                raise Exception('Unknown argument format')
+            new_args.append(self.rewrite_arg(arg))
 
         for key in kwargs:
-            kwarg = kwargs[key]
-            if type(kwarg) is dict:
-                uid = kwarg['uid']
-                data = kwarg['data']
-                if uid is None:
-                    new_kwargs[key] = unserialize(data)
+            new_kwargs[key] = self.rewrite_arg(kwargs[key])
+
+        return new_args, new_kwargs
+
+    def rewrite_arg(self, arg):
+        if type(arg) is dict:
+            uid = arg['uid']
+            data = arg['data']
+            if uid is None:
+                with phase('unserialize'):
+                    return unserialize(data, self.resolve_dataset_ref)
+            return self.lookup_uid(uid)
+        else:
+            raise Exception('Unknown argument format')
+
+    def lookup_uid(self, uid):
+        obj = self._objects.get(uid, None)
+        if obj is not None:
+            return obj
+        return self.cached_dataset(uid)
+
+    def _spill_dataset(self, uid, dataset):
+        if self._spill is not None:
+            self._spill.spill(uid, dataset)
+
+    def dataset_key(self, uid):
+        '''The dataset cache key of the current client's dataset uid.
+
+        The server does not check uploads against their hash, so datasets
+        are only shared among the references of the client that uploaded
+        them: another client cannot have its data served under their hash.
+        '''
+        return (current_client_id(), uid)
+
+    def cached_dataset(self, uid):
+        '''Returns an uploaded dataset from memory or disk, or None.'''
+        key = self.dataset_key(uid)
+        dataset = self._dataset_cache.get(key, None)
+        if dataset is None and self._spill is not None:
+            dataset = self._spill.load(key)
+            if dataset is not None:
+                self._dataset_cache.put(key, dataset, object_nbytes(dataset))
+        return dataset
+
+    def has_cached_dataset(self, uid):
+        key = self.dataset_key(uid)
+        return key in self._dataset_cache or (
+                self._spill is not None and key in self._spill)
+
+    def resolve_dataset_ref(self, key, value):
+        '''Replaces dataset references with cached datasets.
+
+        A reference is {'classType': 'DatasetRef', 'uid': hash, 'data': ds}.
+        If data is given, it is unserialized and cached under uid for the
+        current client. Otherwise the dataset must already be in the
+        client's datasets.
+        '''
+        if type(value) is not dict or value.get('classType') != 'DatasetRef':
+            return value
+
+        uid = value['uid']
+        key = self.dataset_key(uid)
+        data = value.get('data', None)
+        if data is not None:
+            dataset = unserialize(data)
+            self._dataset_cache.put(key, dataset, object_nbytes(dataset))
+        else:
+            dataset = self.cached_dataset(uid)
+            if dataset is None:
+                raise Exception(
+                        'Dataset {} is not cached on the server'.format(uid))
+        # stage results of the dataset are not shared with other clients
+        self.stages.identify(dataset, key)
+        return dataset
+
+    def defer_call(self, fn, args, kwargs, call=None):
+        '''Runs fn in the job pool and publishes its result when done.
+
+        call, the CallMetrics of the RPC, is finished once published. The
+        job and the serialization of its result run with the calling client
+        as current client.
+        '''
+        client_id = current_client_id()
+
+        def run(*args, **kwargs):
+            with client_context(client_id):
+                if call is None:
+                    return fn(*args, **kwargs)
+                with call.active(), call.phase('handler'):
+                    return fn(*args, **kwargs)
+
+        job_id, future = self._jobs.submit(run, (self,) + tuple(args), kwargs,
+                                           owner=client_id)
+
+        def publish_result(retval):
+            with client_context(client_id):
+                if call is None:
+                    result = serialize_result(self, retval)
                 else:
-                    new_kwargs[key] = self._cache.get(uid, None)
+                    with call.active(), call.phase('serialize'):
+                        result = serialize_result(self, retval)
+            result['deferredId'] = job_id
+            result['timings'] = self._jobs.timings(job_id)
+            self.publish('defer.results', result, client_id=client_id)
+            if call is not None:
+                call.finish()
+            startup_profile.mark('first result')
+
+        def publish_error(error):
+            if call is not None:
+                call.finish(error=True)
+            traceback.print_exception(type(error), error, error.__traceback__)
+            self.publish('defer.results', {
+                'deferredId': job_id,
+                'uid': None,
+                'data': None,
+                'error': str(error),
+            }, client_id=client_id)
+
+        def done(future):
+            # called from the job's thread, wslink is called from its loop
+            error = future.exception()
+            if error is None:
+                eventloop.call_from_thread(publish_result, future.result())
             else:
-                raise Exception('Unknown argument format')
+                eventloop.call_from_thread(publish_error, error)
 
-        return new_args, new_kwargs
+        future.add_done_callback(done)
+        return {
+            'uid': None,
+            'data': None,
+            'deferredId': job_id,
+        }
+
+    def publish_partial(self, retval, **info):
+        '''Publishes an intermediate result of the current job.
+
+        The result is sent on defer.results with the job's deferredId and
+        partial set, along with the extra info, before the final result.
+        Does nothing when called outside of a job.
+        '''
+        job = current_job()
+        if job is None:
+            return
+        client_id = current_client_id()
+
+        def publish():
+            with client_context(client_id):
+                result = serialize_result(self, retval)
+            result.update(info)
+            result['deferredId'] = job.id
+            result['partial'] = True
+            self.publish('defer.results', result, client_id=client_id)
+
+        eventloop.call_from_thread(publish)
+
+    def _publish_job_progress(self, job_id, stage, progress):
+        # called from job threads, only the job's client follows it
+        eventloop.call_from_thread(self.publish, 'jobs.progress', {
+            'jobId': job_id,
+            'stage': stage,
+            'progress': progress,
+        }, client_id=self._jobs.owner(job_id))
+
+    def _hold(self, uid):
+        '''Records a reference to uid as held by the current client.'''
+        if uid is not None:
+            self._client_refs.setdefault(current_client_id(), []).append(uid)
+        return uid
+
+    def _release(self, uid):
+        '''Drops a reference to uid held by the current client.'''
+        held = self._client_refs.get(current_client_id(), [])
+        if uid in held:
+            held.remove(uid)
+        return self._objects.release(uid)
 
     def persist(self, obj):
-        uid = str(uuid.uuid4())
-        self._cache[uid] = obj
-        self._persistent_objects[obj] = uid
+        '''Keeps obj on the server, or adds a reference to it.'''
+        return self._hold(self._objects.add(obj))
 
     def delete(self, obj):
-        if obj in self._persistent_objects:
-            uid = self._persistent_objects[obj]
-            del self._persistent_objects[obj]
-            del self._cache[uid]
+        '''Drops a reference to a persisted object.'''
+        uid = self._objects.uid_of(obj)
+        if uid is not None:
+            self._release(uid)
 
     def get_persistent_uid(self, obj):
-        try:
-            return self._persistent_objects.get(obj, None)
-        except:
-            return None
+        return self._objects.uid_of(obj)
+
+    def acquire_uid(self, obj):
+        '''Returns the uid of a persisted obj, referenced once more.
+
+        Used when obj is sent to the client, which releases it with
+        delete_object. Returns None if obj is not persisted.
+        '''
+        return self._hold(self._objects.acquire(obj))
+
+    def onClose(self, client_id=None):
+        '''Releases the references the client held when it disconnects.
+
+        The Api is shared by all clients, so the objects other clients
+        still reference are kept.
+        '''
+        self._codecs.pop(client_id, None)
+        for uid in self._client_refs.pop(client_id, []):
+            self._objects.release(uid)
 
     @rpc('persist_object')
     def persist_object(self, obj):
         '''RPC use only'''
-        uid = str(uuid.uuid4())
-        self._cache[uid] = obj
-        return uid
+        return self.persist(obj)
 
     @rpc('delete_object')
     def delete_object(self, uid):
         '''RPC use only'''
-        if uid in self._cache:
-            del self._cache[uid]
+        return self._release(uid)
+
+    @rpc('get_object_store_stats')
+    def get_object_store_stats(self):
+        '''RPC use only'''
+        return self._objects.stats()
+
+    @rpc('has_dataset')
+    def has_dataset(self, uid):
+        '''RPC use only'''
+        return self.has_cached_dataset(uid)
+
+    @rpc('cancel_job')
+    def cancel_job(self, job_id):
+        '''RPC use only'''
+        # clients only cancel their own jobs
+        if self._jobs.owner(job_id) != current_client_id():
+            return False
+        return self._jobs.cancel(job_id)
+
+    @rpc('get_job_timings')
+    def get_job_timings(self):
+        '''RPC use only'''
+        return self._jobs.timings()
+
+    @rpc('get_metrics')
+    def get_metrics(self):
+        '''RPC use only'''
+        return rpc_metrics.stats()
+
+    @rpc('profile_next_call')
+    def profile_next_call(self, rpc_name):
+        '''RPC use only. Profiles the next call of rpc_name with cProfile.'''
+        rpc_metrics.profile_next(rpc_name)
+
+    @rpc('get_call_profile')
+    def get_call_profile(self, rpc_name):
+        '''RPC use only. The last profile of rpc_name, as text.'''
+        return rpc_metrics.profile(rpc_name)
+
+    @rpc('get_log_metrics')
+    def get_log_metrics(self):
+        '''RPC use only'''
+        return log_metrics.stats()
+
+    @rpc('get_stage_cache_stats')
+    def get_stage_cache_stats(self):
+        '''RPC use only'''
+        return self.stages.stats()
+
+    @rpc('set_codecs')
+    def set_codecs(self, codecs):
+        '''RPC use only. Returns the codecs the server will use.'''
+        accepted = tuple(c for c in codecs if c in CODECS)
+        self._codecs[current_client_id()] = accepted
+        return list(accepted)
@@ -0,0 +1,256 @@
+import os
+import time
+import uuid
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# default number of jobs allowed to run at the same time
+DEFAULT_MAX_JOBS = 1
+
+# minimum seconds between two progress reports of the same job
+PROGRESS_INTERVAL = 0.2
+
+# number of finished jobs whose stage timings are kept
+TIMINGS_HISTORY = 100
+
+# default number of threads shared by the ITK filters of all running jobs
+DEFAULT_MAX_THREADS = os.cpu_count() or 1
+
+_local = threading.local()
+
+class JobCancelled(Exception):
+    pass
+
+class Job(object):
+    '''State of a job running in the pool.
+
+    Filters registered with observe() report their progress through
+    report_progress(job_id, stage, progress), which is called from the job's
+    worker thread, and are aborted when the job is cancelled. They run with
+    the number of threads the runner currently grants the job.
+
+    owner identifies who submitted the job, e.g. a client id, or is None.
+    '''
+
+    def __init__(self, job_id, report_progress=None, runner=None, owner=None):
+        self.id = job_id
+        self.owner = owner
+        self.cancelled = False
+        # threads asked for by the job, None for as many as granted
+        self.requested_threads = None
+        # (stage, wall seconds, CPU seconds, threads) of each timed stage
+        self.timings = []
+        self._runner = runner
+        self._report_progress = report_progress
+        self._filters = []
+        self._last_report = 0
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for itk_filter in self._filters:
+                itk_filter.AbortGenerateDataOn()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled('Job {} was cancelled'.format(self.id))
+
+    def threads(self):
+        '''Number of threads the job's next filter may use.'''
+        share = self._runner.thread_share() if self._runner else 1
+        if self.requested_threads:
+            return min(self.requested_threads, share)
+        return share
+
+    def observe(self, itk_filter, stage):
+        import itk
+
+        with self._lock:
+            self.check_cancelled()
+            self._filters.append(itk_filter)
+
+        threads = self.threads()
+        itk_filter.SetNumberOfWorkUnits(threads)
+        itk_filter.GetMultiThreader().SetMaximumNumberOfThreads(threads)
+
+        def on_progress():
+            self.progress(stage, itk_filter.GetProgress())
+
+        itk_filter.AddObserver(itk.ProgressEvent(), on_progress)
+        return itk_filter
+
+    def progress(self, stage, progress):
+        now = time.monotonic()
+        if progress < 1 and now - self._last_report < PROGRESS_INTERVAL:
+            return
+        self._last_report = now
+        if self._report_progress:
+            self._report_progress(self.id, stage, progress)
+
+def current_job():
+    '''The job running in the calling thread, or None.'''
+    return getattr(_local, 'job', None)
+
+def observe_filter(itk_filter, stage):
+    '''Reports progress of an ITK filter and lets the current job abort it.
+
+    Does nothing when called outside of a job.
+    '''
+    job = current_job()
+    if job is not None:
+        job.observe(itk_filter, stage)
+    return itk_filter
+
+def check_cancelled():
+    '''Raises JobCancelled if the current job has been cancelled.'''
+    job = current_job()
+    if job is not None:
+        job.check_cancelled()
+
+def request_threads(threads):
+    '''Limits the threads used by the current job's filters.
+
+    The job never gets more than its share of the runner's threads; 0 or
+    None asks for the whole share.
+    '''
+    job = current_job()
+    if job is not None:
+        job.requested_threads = threads or None
+
+@contextmanager
+def timed_stage(stage):
+    '''Records the wall and CPU time of a stage of the current job.
+
+    CPU time is that of the whole process, so it includes ITK worker
+    threads but also any job running at the same time.
+    '''
+    job = current_job()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        if job is not None:
+            job.timings.append((stage, time.perf_counter() - wall,
+                                time.process_time() - cpu, job.threads()))
+
+def configure_itk_threads(max_threads):
+    '''Caps the threads of ITK's global thread pool.'''
+    import itk
+
+    itk.MultiThreaderBase.SetGlobalMaximumNumberOfThreads(max_threads)
+    itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(max_threads)
+
+class JobRunner(object):
+    '''Runs long-running calls in a worker thread pool.
+
+    ITK releases the GIL while filters execute, so worker threads keep the
+    event loop thread free to answer other RPCs. Results are delivered
+    through futures, whose callbacks run in the worker thread.
+
+    max_threads are divided evenly among the jobs running at the time a
+    filter is set up, so concurrent jobs neither oversubscribe the cores
+    nor leave them idle once the other jobs are done.
+    '''
+
+    def __init__(self, max_jobs=DEFAULT_MAX_JOBS, report_progress=None,
+                 max_threads=DEFAULT_MAX_THREADS):
+        self.max_jobs = max_jobs
+        self.max_threads = max_threads
+        self.report_progress = report_progress
+        self._pool = None
+        self._jobs = {}
+        self._timings = deque(maxlen=TIMINGS_HISTORY)
+        self._running = 0
+        self._running_lock = threading.Lock()
+
+    def thread_share(self):
+        return max(1, self.max_threads // max(self._running, 1))
+
+    def _get_pool(self):
+        if self._pool is None:
+            configure_itk_threads(self.max_threads)
+            self._pool = ThreadPoolExecutor(self.max_jobs)
+        return self._pool
+
+    def _run(self, job, fn, args, kwargs):
+        _local.job = job
+        with self._running_lock:
+            self._running += 1
+        try:
+            job.check_cancelled()
+            return fn(*args, **kwargs)
+        except JobCancelled:
+            raise
+        except Exception:
+            # aborted ITK filters raise their own exceptions
+            job.check_cancelled()
+            raise
+        finally:
+            with self._running_lock:
+                self._running -= 1
+            _local.job = None
+
+    def _run_submitted(self, job, fn, args, kwargs):
+        try:
+            return self._run(job, fn, args, kwargs)
+        finally:
+            # before the future is done, so its callbacks see the timings
+            self._jobs.pop(job.id, None)
+            self._timings.append({
+                'jobId': job.id,
+                'stages': [
+                    {'stage': stage, 'wall': wall, 'cpu': cpu,
+                     'threads': threads}
+                    for stage, wall, cpu, threads in job.timings
+                ],
+            })
+
+    def submit(self, fn, args=(), kwargs=None, owner=None):
+        '''Schedules fn(*args, **kwargs) on the pool.
+
+        Returns (job_id, future). The future completes in a worker thread
+        with the return value of fn, or with its exception.
+        '''
+        job_id = str(uuid.uuid4())
+        job = Job(job_id, self.report_progress, self, owner)
+        self._jobs[job_id] = job
+        future = self._get_pool().submit(self._run_submitted,
+                                         job, fn, args, kwargs or {})
+        return job_id, future
+
+    def run_now(self, fn, *args, **kwargs):
+        '''Runs fn(*args, **kwargs) as a job in the calling thread.
+
+        Bypasses the pool. Returns (return value, job).
+        '''
+        job = Job(str(uuid.uuid4()), self.report_progress, self)
+        return self._run(job, fn, args, kwargs), job
+
+    def cancel(self, job_id):
+        '''Cancels a job. Returns False if it is not queued or running.'''
+        job = self._jobs.get(job_id, None)
+        if job is None:
+            return False
+        job.cancel()
+        return True
+
+    def owner(self, job_id):
+        '''Owner of a queued or running job, or None.'''
+        job = self._jobs.get(job_id, None)
+        return job.owner if job is not None else None
+
+    def running_jobs(self):
+        return list(self._jobs.keys())
+
+    def timings(self, job_id=None):
+        '''Stage timings of the recently finished jobs, or of one of them.'''
+        if job_id is None:
+            return list(self._timings)
+        for entry in reversed(self._timings):
+            if entry['jobId'] == job_id:
+                return entry
+        return None
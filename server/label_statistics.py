@@ -0,0 +1,53 @@
+import numpy as np
+
+def compute_label_statistics(arr_labelmap, arr_image):
+    '''Gathers per-label statistics of an image in a single pass.
+
+    Only labelled (non-zero) voxels are visited, so memory is bounded by the
+    number of labelled voxels rather than labels x volume size.
+
+    Returns a dict of label id -> {
+        'count': number of voxels,
+        'mean', 'std': of the image values, computed in raster order,
+        'sorted_values': image values sorted ascending,
+        'indices': flat (C order) voxel indices in raster order,
+    }
+    '''
+    flat_labelmap = arr_labelmap.ravel()
+    flat_image = arr_image.ravel()
+
+    indices = np.flatnonzero(flat_labelmap)
+    labels = flat_labelmap[indices]
+
+    # a stable sort keeps each label's voxels in raster order
+    order = np.argsort(labels, kind='stable')
+    indices = indices[order]
+    labels = labels[order]
+    del order
+    values = flat_image[indices]
+
+    ids, starts, counts = np.unique(labels, return_index=True,
+                                    return_counts=True)
+
+    stats = {}
+    for label_id, start, count in zip(ids, starts, counts):
+        label_values = values[start:start+count]
+        mean = np.mean(label_values)
+        std = np.std(label_values)
+        # sorted in place; serves as the label's cumulative histogram
+        label_values.sort()
+        stats[label_id.item()] = {
+            'count': int(count),
+            'mean': mean,
+            'std': std,
+            'sorted_values': label_values,
+            'indices': indices[start:start+count],
+        }
+    return stats
+
+def label_ids(arr_labelmap, stats):
+    '''Sorted label ids of the labelmap, including 0 if it is present.'''
+    ids = np.array(sorted(stats.keys()), dtype=arr_labelmap.dtype)
+    if sum(s['count'] for s in stats.values()) < arr_labelmap.size:
+        ids = np.union1d(ids, np.zeros(1, dtype=arr_labelmap.dtype))
+    return ids
@@ -0,0 +1,277 @@
+import io
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# upper bounds of the histogram buckets, in seconds
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+# ...and in bytes
+SIZE_BUCKETS = tuple(2**n for n in range(10, 34, 4))
+
+# number of functions listed in a call profile
+PROFILE_LINES = 40
+
+_local = threading.local()
+
+def peak_rss():
+    '''Peak resident memory of the process in bytes, or 0 if unknown.'''
+    if resource is None:
+        return 0
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else 0,
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+        }
+
+class CallMetrics(object):
+    '''Measurements of a single RPC call.
+
+    Phases may be nested, and a phase entered several times accumulates.
+    A deferred call is carried over to the job thread and finished once
+    its result is published.
+    '''
+
+    def __init__(self, rpc):
+        self.rpc = rpc
+        self.phases = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.attachments = 0
+        self.error = False
+        self.rss_delta = 0
+        self._start = time.perf_counter()
+        self._peak_rss = peak_rss()
+        self._profile = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + \
+                    time.perf_counter() - start
+
+    @contextmanager
+    def active(self):
+        '''Makes this the call measured by phase() in the calling thread.
+
+        Also profiles the thread if the call was picked by profile_next.
+        '''
+        previous = getattr(_local, 'call', None)
+        _local.call = self
+        if self._profile is not None:
+            self._profile.enable()
+        try:
+            yield self
+        finally:
+            if self._profile is not None:
+                self._profile.disable()
+            _local.call = previous
+
+    def attachment(self, nbytes):
+        self.attachments += 1
+        self.bytes_out += nbytes
+
+    def finish(self, error=False):
+        self.error = error
+        self.phases['total'] = time.perf_counter() - self._start
+        self.rss_delta = peak_rss() - self._peak_rss
+        metrics.record(self)
+
+@contextmanager
+def phase(name):
+    '''Times a phase of the RPC call running in the calling thread.'''
+    call = getattr(_local, 'call', None)
+    if call is None:
+        yield
+        return
+    with call.phase(name):
+        yield
+
+def current_call():
+    return getattr(_local, 'call', None)
+
+class RpcStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.phases = {}
+        self.bytes_in = Histogram(SIZE_BUCKETS)
+        self.bytes_out = Histogram(SIZE_BUCKETS)
+        self.attachments = 0
+        self.rss_delta = Histogram(SIZE_BUCKETS)
+
+    def add(self, call):
+        self.calls += 1
+        self.errors += int(call.error)
+        for name, seconds in call.phases.items():
+            if name not in self.phases:
+                self.phases[name] = Histogram(TIME_BUCKETS)
+            self.phases[name].observe(seconds)
+        self.bytes_in.observe(call.bytes_in)
+        self.bytes_out.observe(call.bytes_out)
+        self.attachments += call.attachments
+        self.rss_delta.observe(call.rss_delta)
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'phases': {name: h.stats() for name, h in self.phases.items()},
+            'bytesIn': self.bytes_in.stats(),
+            'bytesOut': self.bytes_out.stats(),
+            'attachments': self.attachments,
+            'peakRssDelta': self.rss_delta.stats(),
+        }
+
+class RpcMetrics(object):
+    '''Aggregates the measurements of RPC calls into histograms.
+
+    With dump(path, format), every finished call is also written to a file:
+    appended as a JSON line ('jsonl'), or by rewriting the file with all
+    aggregates in the Prometheus text format ('prometheus').
+    '''
+
+    def __init__(self):
+        self._rpcs = {}
+        self._profiles = {}
+        self._profile_next = set()
+        self._dump_path = None
+        self._dump_format = None
+        self._lock = threading.Lock()
+
+    def start(self, rpc):
+        call = CallMetrics(rpc)
+        with self._lock:
+            if rpc in self._profile_next:
+                self._profile_next.discard(rpc)
+                call._profile = cProfile.Profile()
+        return call
+
+    def record(self, call):
+        with self._lock:
+            if call.rpc not in self._rpcs:
+                self._rpcs[call.rpc] = RpcStats()
+            self._rpcs[call.rpc].add(call)
+            if call._profile is not None:
+                out = io.StringIO()
+                pstats.Stats(call._profile, stream=out) \
+                    .sort_stats('cumulative').print_stats(PROFILE_LINES)
+                self._profiles[call.rpc] = out.getvalue()
+        if self._dump_path:
+            self._dump(call)
+
+    def profile_next(self, rpc):
+        '''Profiles the next call of rpc with cProfile.'''
+        with self._lock:
+            self._profile_next.add(rpc)
+
+    def profile(self, rpc):
+        '''The profile of the last profiled call of rpc, as text, or None.'''
+        return self._profiles.get(rpc, None)
+
+    def dump(self, path, format='jsonl'):
+        assert format in ('jsonl', 'prometheus')
+        self._dump_path = path
+        self._dump_format = format
+
+    def _dump(self, call):
+        if self._dump_format == 'jsonl':
+            line = json.dumps({
+                'time': time.time(),
+                'rpc': call.rpc,
+                'error': call.error,
+                'phases': call.phases,
+                'bytesIn': call.bytes_in,
+                'bytesOut': call.bytes_out,
+                'attachments': call.attachments,
+                'peakRssDelta': call.rss_delta,
+            })
+            with open(self._dump_path, 'a') as f:
+                f.write(line + '\n')
+        else:
+            tmp = self._dump_path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(self.prometheus())
+            os.replace(tmp, self._dump_path)
+
+    def stats(self):
+        with self._lock:
+            return {rpc: s.stats() for rpc, s in self._rpcs.items()}
+
+    def prometheus(self):
+        '''All aggregates in the Prometheus text exposition format.'''
+        lines = []
+
+        def histogram(metric, labels, h):
+            cumulative = 0
+            for bound, count in zip(h.buckets, h.counts):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    metric, labels, bound, cumulative))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                metric, labels, h.count))
+            lines.append('{}_sum{{{}}} {}'.format(metric, labels, h.sum))
+            lines.append('{}_count{{{}}} {}'.format(metric, labels, h.count))
+
+        with self._lock:
+            rpcs = sorted(self._rpcs.items())
+            lines.append('# TYPE rpc_calls_total counter')
+            for rpc, s in rpcs:
+                lines.append('rpc_calls_total{{rpc="{}"}} {}'.format(rpc, s.calls))
+            lines.append('# TYPE rpc_errors_total counter')
+            for rpc, s in rpcs:
+                lines.append('rpc_errors_total{{rpc="{}"}} {}'.format(rpc, s.errors))
+            lines.append('# TYPE rpc_attachments_total counter')
+            for rpc, s in rpcs:
+                lines.append('rpc_attachments_total{{rpc="{}"}} {}'.format(
+                    rpc, s.attachments))
+            lines.append('# TYPE rpc_phase_seconds histogram')
+            for rpc, s in rpcs:
+                for name, h in sorted(s.phases.items()):
+                    histogram('rpc_phase_seconds',
+                              'rpc="{}",phase="{}"'.format(rpc, name), h)
+            for metric, attr in (('rpc_bytes_in', 'bytes_in'),
+                                 ('rpc_bytes_out', 'bytes_out'),
+                                 ('rpc_peak_rss_delta_bytes', 'rss_delta')):
+                lines.append('# TYPE {} histogram'.format(metric))
+                for rpc, s in rpcs:
+                    histogram(metric, 'rpc="{}"'.format(rpc), getattr(s, attr))
+        return '\n'.join(lines) + '\n'
+
+metrics = RpcMetrics()
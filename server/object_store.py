@@ -0,0 +1,117 @@
+import uuid
+
+from cache import LRUCache
+from transformers import object_nbytes
+
+# default byte budget of the objects kept for clients
+DEFAULT_OBJECT_STORE_SIZE = 2 * 2**30
+
+_missing = object()
+
+class ObjectStore(object):
+    '''Server-side objects referenced by clients through uids.
+
+    Each object is stored once, with the memory held by its pixel buffers,
+    and counts the references handed out for it: adding an object that is
+    already stored returns its uid and adds a reference, and the object is
+    dropped once all references are released. The store is bounded by a
+    byte budget; when it is exceeded, the least recently used objects are
+    evicted even if they are still referenced.
+
+    With a SpillDirectory, evicted volumes are written to disk instead and
+    reopened when their uid is looked up again.
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_OBJECT_STORE_SIZE, spill=None):
+        self._spill = spill
+        self._objects = LRUCache(max_bytes, on_evict=self._evict)
+        # id(obj) -> uid, valid as long as obj is in the store
+        self._uids = {}
+        self._refs = {}
+
+    def __contains__(self, uid):
+        return uid in self._objects or (
+                self._spill is not None and uid in self._spill)
+
+    def __len__(self):
+        return len(self._objects)
+
+    def _evict(self, uid, obj):
+        del self._uids[id(obj)]
+        if self._spill is not None and self._spill.spill(uid, obj):
+            # still referenced, now on disk
+            return
+        del self._refs[uid]
+
+    def _forget(self, uid, obj):
+        if obj is not None:
+            del self._uids[id(obj)]
+        del self._refs[uid]
+        if self._spill is not None:
+            self._spill.discard(uid)
+
+    def add(self, obj):
+        '''Stores obj, or adds a reference to it. Returns its uid.'''
+        uid = self._uids.get(id(obj), None)
+        if uid is not None:
+            self._refs[uid] += 1
+            return uid
+
+        uid = str(uuid.uuid4())
+        nbytes = object_nbytes(obj)
+        # registered first, as storing may evict other objects
+        self._uids[id(obj)] = uid
+        self._refs[uid] = 1
+        if not self._objects.put(uid, obj, nbytes):
+            self._forget(uid, obj)
+            raise Exception(
+                    'Object of {} bytes does not fit in the object store'
+                    .format(nbytes))
+        return uid
+
+    def get(self, uid, default=None):
+        obj = self._objects.get(uid, _missing)
+        if obj is not _missing:
+            return obj
+        if self._spill is None or uid not in self._spill:
+            return default
+
+        obj = self._spill.load(uid)
+        self._uids[id(obj)] = uid
+        self._objects.put(uid, obj, object_nbytes(obj))
+        return obj
+
+    def uid_of(self, obj):
+        '''The uid of obj if it is stored, else None.'''
+        return self._uids.get(id(obj), None)
+
+    def acquire(self, obj):
+        '''Adds a reference to obj if it is stored. Returns its uid or None.'''
+        uid = self.uid_of(obj)
+        if uid is not None:
+            self._refs[uid] += 1
+        return uid
+
+    def release(self, uid):
+        '''Drops a reference. Returns False if uid is not stored.'''
+        if uid not in self._refs:
+            return False
+        self._refs[uid] -= 1
+        if self._refs[uid] == 0:
+            self._forget(uid, self._objects.pop(uid))
+        return True
+
+    def clear(self):
+        if self._spill is not None:
+            for uid in self._refs:
+                self._spill.discard(uid)
+        self._objects.clear()
+        self._uids.clear()
+        self._refs.clear()
+
+    def stats(self):
+        stats = self._objects.stats()
+        stats['references'] = sum(self._refs.values())
+        if self._spill is not None:
+            stats['spilled'] = self._spill.stats()
+        return stats
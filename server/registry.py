@@ -0,0 +1,236 @@
+import os
+import abc
+import sys
+import json
+import importlib
+import threading
+from collections import OrderedDict
+
+from helper import Api, rpc, forward_stdout, current_client_id
+from startup import profile as startup_profile
+
+# entry point group under which packages declare algorithms, e.g. in setup.py:
+#   entry_points={'glance.algorithms': ['otsu = my_package.otsu:Otsu']}
+ENTRY_POINT_GROUP = 'glance.algorithms'
+
+# keys of the *.json files of an algorithms directory, see load_directory
+SPEC_REQUIRED_KEYS = {'name', 'target'}
+SPEC_OPTIONAL_KEYS = {'label', 'parameters', 'prewarm'}
+
+# algorithm run when a call does not name one
+DEFAULT_ALGORITHM = 'hello_world'
+
+class Algorithm(abc.ABC):
+    '''Base class of the algorithms hosted by an AlgorithmApi.
+
+    An algorithm runs in a job of the api hosting it, and may use its stage
+    cache and publish partial results. Its module is only imported when the
+    algorithm is first used. Subclasses must implement run.
+    '''
+
+    def __init__(self, api):
+        self.api = api
+
+    @property
+    def stages(self):
+        return self.api.stages
+
+    def publish_partial(self, retval, **info):
+        self.api.publish_partial(retval, **info)
+
+    @classmethod
+    def prewarm(cls):
+        '''Loads the ITK modules and filter instantiations the algorithm
+        needs. Called in a background thread at server startup.
+        '''
+        pass
+
+    @classmethod
+    def parameters(cls):
+        '''The parameter schema returned by get_parameters.'''
+        return []
+
+    @abc.abstractmethod
+    def run(self, params):
+        '''Runs the algorithm on the parameters of a run call.
+
+        params maps parameter names to values, sources being unserialized
+        datasets. Returns the result sent to the client.
+        '''
+
+class AlgorithmSpec(object):
+    '''A registered algorithm, imported on first use.
+
+    target is 'module:Class'. If parameters is given, get_parameters returns
+    it without importing the module. path is added to sys.path before
+    importing, for modules living in an algorithms directory.
+    '''
+
+    def __init__(self, name, target, label=None, parameters=None,
+                 prewarm=False, path=None):
+        self.name = name
+        self.target = target
+        self.label = label or name
+        self.prewarm_at_startup = prewarm
+        self.path = path
+        self._parameters = parameters
+        self._class = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._class is not None
+
+    def load(self):
+        with self._lock:
+            if self._class is None:
+                module_name, _, class_name = self.target.partition(':')
+                if self.path and self.path not in sys.path:
+                    sys.path.append(self.path)
+                with startup_profile.timed('import ' + module_name):
+                    module = importlib.import_module(module_name)
+                self._class = getattr(module, class_name)
+            return self._class
+
+    def parameters(self):
+        if self._parameters is not None:
+            return self._parameters
+        return self.load().parameters()
+
+    def prewarm(self):
+        self.load().prewarm()
+
+    def describe(self):
+        return {'name': self.name, 'label': self.label}
+
+class AlgorithmRegistry(object):
+    '''Algorithms declared by name, in registration order.'''
+
+    def __init__(self):
+        self._specs = OrderedDict()
+
+    def register(self, name, target, **kwargs):
+        self._specs[name] = AlgorithmSpec(name, target, **kwargs)
+        return self._specs[name]
+
+    def load_entry_points(self, group=ENTRY_POINT_GROUP):
+        '''Registers the algorithms declared as entry points of group.'''
+        from importlib.metadata import entry_points
+
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=group)
+        else:
+            # Python < 3.10 returns a dict of entry points by group
+            eps = eps.get(group, [])
+        for ep in eps:
+            self.register(ep.name, ep.value)
+
+    def load_directory(self, path):
+        '''Registers the algorithms described by the *.json files of path.
+
+        Each file holds an object with name and target ('module:Class'),
+        and optionally label, parameters and prewarm. Modules may live in
+        path itself.
+        '''
+        path = os.path.abspath(path)
+        for filename in sorted(os.listdir(path)):
+            if not filename.endswith('.json'):
+                continue
+            filepath = os.path.join(path, filename)
+            try:
+                with open(filepath) as f:
+                    spec = json.load(f)
+            except ValueError as e:
+                raise Exception('Invalid algorithm file {}: {}'.format(
+                        filepath, e))
+            if not isinstance(spec, dict):
+                raise Exception(
+                        'Invalid algorithm file {}: not an object'.format(
+                            filepath))
+            missing = SPEC_REQUIRED_KEYS - spec.keys()
+            if missing:
+                raise Exception('Invalid algorithm file {}: missing {}'.format(
+                        filepath, ', '.join(sorted(missing))))
+            unknown = spec.keys() - SPEC_REQUIRED_KEYS - SPEC_OPTIONAL_KEYS
+            if unknown:
+                raise Exception('Invalid algorithm file {}: unknown {}'.format(
+                        filepath, ', '.join(sorted(unknown))))
+            self.register(spec.pop('name'), spec.pop('target'), path=path,
+                          **spec)
+
+    def load(self, algorithms_dirs=()):
+        '''Registers the algorithms of entry points and directories.'''
+        self.load_entry_points()
+        for path in algorithms_dirs:
+            self.load_directory(path)
+
+    def get(self, name=None):
+        if name is None:
+            name = DEFAULT_ALGORITHM if DEFAULT_ALGORITHM in self._specs \
+                    else next(iter(self._specs))
+        try:
+            return self._specs[name]
+        except KeyError:
+            raise Exception('Unknown algorithm: {}'.format(name))
+
+    def specs(self):
+        return list(self._specs.values())
+
+registry = AlgorithmRegistry()
+registry.register(DEFAULT_ALGORITHM, 'hello_world:HelloWorld',
+                  label='Hello world', prewarm=True)
+
+class AlgorithmApi(Api):
+    '''Hosts the algorithms of a registry, dispatching calls by name.
+
+    Each algorithm is instantiated once, on its first run. If a WorkerPool
+    is given, algorithms run in the worker process assigned to the calling
+    client instead. wslink shares one api between all its connections, so
+    clients are told apart by their wslink client id.
+    '''
+
+    def __init__(self, registry=registry, workers=None, **kwargs):
+        super().__init__(**kwargs)
+        self.registry = registry
+        self.workers = workers
+        self._algorithms = {}
+        self._algorithms_lock = threading.Lock()
+
+    def algorithm(self, name=None):
+        spec = self.registry.get(name)
+        with self._algorithms_lock:
+            if spec.name not in self._algorithms:
+                self._algorithms[spec.name] = spec.load()(self)
+            return self._algorithms[spec.name]
+
+    @rpc('list_algorithms')
+    def list_algorithms(self):
+        '''RPC use only'''
+        return [spec.describe() for spec in self.registry.specs()]
+
+    @rpc('get_parameters')
+    def params(self, algorithm=None):
+        '''RPC use only'''
+        return self.registry.get(algorithm).parameters()
+
+    @rpc('run', deferred=True)
+    @forward_stdout
+    def run(self, params, algorithm=None):
+        if self.workers is not None:
+            worker = self.workers.acquire(current_client_id())
+            return worker.run(algorithm, params, self.stages.key_of,
+                              self.publish_partial)
+        return self.algorithm(algorithm).run(params)
+
+    @rpc('get_worker_stats')
+    def get_worker_stats(self):
+        '''RPC use only'''
+        if self.workers is None:
+            return None
+        return self.workers.stats()
+
+    def onClose(self, client_id=None):
+        super().onClose(client_id)
+        if self.workers is not None:
+            self.workers.release(client_id)
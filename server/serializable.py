@@ -1,70 +1,105 @@
-import copy
-
 serializers = []
 unserializers = []
 
-def clone(o):
-    try:
-        return copy.copy(o)
-    except:
-        return o
+def _accepts(types, cls):
+    if types is None:
+        return True
+    if isinstance(types, tuple):
+        return issubclass(cls, types)
+    return types(cls)
 
 class JSONRecurser(object):
+    '''Recursively transforms dicts, lists and tuples.
+
+    Transformers are registered with a tester(key, value) and optionally
+    the types they apply to, either as a tuple of classes or a predicate
+    on the class. The transformers that apply to a given Python type are
+    looked up once and cached, so leaves that no transformer handles cost
+    one dict lookup. Containers are only copied if a transformer changed
+    something inside of them.
+    '''
     def __init__(self):
         self.transformers = []
+        self._dispatch = {}
+
+    def register_transformer(self, fn, tester=None, types=None):
+        self.transformers.append((fn, tester, types))
+        self._dispatch.clear()
 
-    def register_transformer(self, fn, tester):
-        self.transformers.append((fn, tester))
+    def _candidates(self, cls):
+        try:
+            return self._dispatch[cls]
+        except KeyError:
+            candidates = tuple(
+                (fn, tester) for fn, tester, types in self.transformers
+                if _accepts(types, cls))
+            self._dispatch[cls] = candidates
+            return candidates
 
     def replace(self, key, value):
-        for transformer, tester in self.transformers:
-            flag = False
+        for transformer, tester in self._candidates(type(value)):
+            flag = True
 
-            try:
-                flag = tester(key, value)
-            except Exception as e:
-                # TODO debug log exception
-                pass
+            if tester is not None:
+                try:
+                    flag = tester(key, value)
+                except Exception as e:
+                    # TODO debug log exception
+                    flag = False
 
             if flag:
                 return transformer(key, value)
 
         return value
 
-    def recurse(self, obj, extra_transformer=lambda k, v: v):
-        def replacer(key, value):
-            new_value = self.replace(key, value)
-            return extra_transformer(key, new_value)
+    def recurse(self, obj, extra_transformer=None):
+        if extra_transformer is None:
+            replacer = self.replace
+        else:
+            def replacer(key, value):
+                new_value = self.replace(key, value)
+                return extra_transformer(key, new_value)
 
         return self._recurse(replacer(None, obj), replacer)
 
     def _recurse(self, obj, replacer):
-        obj = clone(obj)
-        if type(obj) is dict:
-            for key in obj:
-                value = obj[key]
-                obj[key] = self._recurse(replacer(key, value), replacer)
-        elif type(obj) is list or type(obj) is tuple:
-            listObj = []
-            for i, v in enumerate(obj):
-                listObj.append(self._recurse(replacer(i, v), replacer))
-            obj = type(obj)(listObj)
+        cls = type(obj)
+        if cls is dict:
+            new_obj = None
+            for key, value in obj.items():
+                new_value = self._recurse(replacer(key, value), replacer)
+                if new_value is not value:
+                    if new_obj is None:
+                        new_obj = dict(obj)
+                    new_obj[key] = new_value
+            return obj if new_obj is None else new_obj
+        elif cls is list or cls is tuple:
+            new_obj = None
+            for i, value in enumerate(obj):
+                new_value = self._recurse(replacer(i, value), replacer)
+                if new_value is not value:
+                    if new_obj is None:
+                        new_obj = list(obj)
+                    new_obj[i] = new_value
+            if new_obj is None:
+                return obj
+            return new_obj if cls is list else tuple(new_obj)
         return obj
 
 _serializeRecurser = JSONRecurser()
 _unserializeRecurser = JSONRecurser()
 
 # decorator
-def serializer(tester):
+def serializer(tester=None, types=None):
     def wrapper(fn):
-        _serializeRecurser.register_transformer(fn, tester)
+        _serializeRecurser.register_transformer(fn, tester, types)
         return fn
     return wrapper
 
 # decorator
-def unserializer(tester):
+def unserializer(tester=None, types=None):
     def wrapper(fn):
-        _unserializeRecurser.register_transformer(fn, tester)
+        _unserializeRecurser.register_transformer(fn, tester, types)
         return fn
     return wrapper
 
@@ -1,14 +1,28 @@
+# imported first, so that the startup profile includes the other imports
+from startup import profile as startup_profile, start_prewarm
+
 import sys
 import os
 import webbrowser
 import socket
 import argparse
+import multiprocessing
 
 from wslink.websocket import ServerProtocol
 from wslink import server
-from twisted.internet import reactor
 
-from hello_world import AlgorithmApi
+import eventloop
+from registry import AlgorithmApi, registry
+from helper import DEFAULT_DATASET_CACHE_SIZE
+from jobs import DEFAULT_MAX_JOBS, DEFAULT_MAX_THREADS
+from chunking import DEFAULT_CHUNK_SIZE
+from stages import DEFAULT_STAGE_CACHE_SIZE
+from object_store import DEFAULT_OBJECT_STORE_SIZE
+from spill import DEFAULT_SPILL_SIZE
+from metrics import metrics as rpc_metrics
+from workers import WorkerPool, DEFAULT_WORKERS, DEFAULT_MAX_WORKER_RSS
+
+startup_profile.mark('modules imported')
 
 def get_port():
     '''Don't care about race condition here for getting a free port.'''
@@ -21,16 +35,28 @@ def get_port():
 class AlgorithmServer(ServerProtocol):
     # TODO change this default secret
     authKey = 'wslink-secret'
+    apiOptions = {}
+    # called without arguments once the server listens
+    listeningCallbacks = []
 
     @staticmethod
     def configure(options):
         AlgorithmServer.authKey = options.authKey
 
+    @staticmethod
+    def port_callback(port):
+        # called by wslink from its event loop, once listening on port
+        for callback in AlgorithmServer.listeningCallbacks:
+            callback()
+
     def initialize(self):
-        self.registerLinkProtocol(AlgorithmApi())
+        self.registerLinkProtocol(AlgorithmApi(**AlgorithmServer.apiOptions))
         self.updateSecret(AlgorithmServer.authKey)
 
 if __name__ == '__main__':
+    # worker processes of frozen builds start from this executable
+    multiprocessing.freeze_support()
+
     # https://stackoverflow.com/questions/7674790/bundling-data-files-with-pyinstaller-onefile
     try:
         basepath = sys._MEIPASS
@@ -44,9 +70,92 @@ if __name__ == '__main__':
                         help='Port for server to listen on')
     parser.add_argument('-b', '--no-browser', action='store_true',
                         help='Do not auto-open the browser')
+    parser.add_argument('--dataset-cache-size', type=int,
+                        default=DEFAULT_DATASET_CACHE_SIZE // 2**20,
+                        help='Memory budget in MB for cached input datasets')
+    parser.add_argument('--max-jobs', type=int, default=DEFAULT_MAX_JOBS,
+                        help='Number of algorithm runs allowed in parallel, '
+                             'at least --workers with worker processes')
+    parser.add_argument('--threads', type=int, default=DEFAULT_MAX_THREADS,
+                        help='Number of threads shared by the ITK filters '
+                             'of all running algorithm jobs')
+    parser.add_argument('--max-chunk-size', type=int,
+                        default=DEFAULT_CHUNK_SIZE // 2**20,
+                        help='Largest binary attachment sent, in MB; '
+                             'larger arrays are split into chunks')
+    parser.add_argument('--stage-cache-size', type=int,
+                        default=DEFAULT_STAGE_CACHE_SIZE // 2**20,
+                        help='Memory budget in MB for memoized intermediate '
+                             'results of the algorithm')
+    parser.add_argument('--object-store-size', type=int,
+                        default=DEFAULT_OBJECT_STORE_SIZE // 2**20,
+                        help='Memory budget in MB for objects kept for the '
+                             'client')
+    parser.add_argument('--spill-dir', default=None,
+                        help='Directory where volumes evicted from memory are '
+                             'kept; disabled if not given')
+    parser.add_argument('--spill-size', type=int,
+                        default=DEFAULT_SPILL_SIZE // 2**20,
+                        help='Disk budget in MB of the spill directory')
+    parser.add_argument('--metrics-file', default=None,
+                        help='File where RPC metrics are written after '
+                             'each call')
+    parser.add_argument('--metrics-format', default='jsonl',
+                        choices=['jsonl', 'prometheus'],
+                        help='jsonl appends one line per call; prometheus '
+                             'rewrites the aggregates in the text format')
+    parser.add_argument('--algorithms-dir', action='append', default=[],
+                        help='Directory of algorithm descriptions (*.json) '
+                             'and modules, may be repeated')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Number of worker processes running the '
+                             'algorithms, one per session while there are '
+                             'enough; 0 runs them in the server process')
+    parser.add_argument('--worker-max-rss', type=int,
+                        default=DEFAULT_MAX_WORKER_RSS // 2**20,
+                        help='Peak memory in MB after which a worker process '
+                             'is replaced')
+    parser.add_argument('--no-prewarm', action='store_true',
+                        help='Do not load ITK in the background at startup')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='Report import and filter instantiation timings '
+                             'up to the first algorithm result')
     args = parser.parse_args()
     print(args)
 
+    if args.metrics_file:
+        rpc_metrics.dump(args.metrics_file, args.metrics_format)
+
+    # algorithm modules are only imported when first used
+    registry.load(args.algorithms_dir)
+
+    AlgorithmServer.apiOptions['dataset_cache_size'] = \
+            args.dataset_cache_size * 2**20
+    AlgorithmServer.apiOptions['max_jobs'] = args.max_jobs
+    AlgorithmServer.apiOptions['max_threads'] = args.threads
+    AlgorithmServer.apiOptions['chunk_size'] = args.max_chunk_size * 2**20
+    AlgorithmServer.apiOptions['stage_cache_size'] = \
+            args.stage_cache_size * 2**20
+    AlgorithmServer.apiOptions['object_store_size'] = \
+            args.object_store_size * 2**20
+    AlgorithmServer.apiOptions['spill_dir'] = args.spill_dir
+    AlgorithmServer.apiOptions['spill_size'] = args.spill_size * 2**20
+
+    workers = None
+    if args.workers > 0:
+        # worker processes share volumes through multiprocessing.shared_memory
+        if sys.version_info < (3, 8):
+            parser.error('--workers needs Python 3.8 or newer')
+        # front end jobs wait on their worker, one per running call
+        AlgorithmServer.apiOptions['max_jobs'] = max(args.max_jobs,
+                                                     args.workers)
+        workers = WorkerPool(args.workers, args.worker_max_rss * 2**20,
+                             threads=max(1, args.threads // args.workers),
+                             stage_cache_size=args.stage_cache_size * 2**20,
+                             algorithms_dirs=args.algorithms_dir,
+                             prewarm=not args.no_prewarm)
+    AlgorithmServer.apiOptions['workers'] = workers
+
     static_dir = os.path.join(basepath, 'www')
     host = args.host
     port = args.port
@@ -65,8 +174,20 @@ if __name__ == '__main__':
     def open_webapp():
         webbrowser.open(full_url)
 
+    # ITK is only imported once the server listens
+    startup_profile.enabled = args.startup_profile
+    AlgorithmServer.listeningCallbacks.append(
+            lambda: startup_profile.mark('listening'))
     if not args.no_browser:
-        reactor.callLater(0.1, open_webapp)
+        AlgorithmServer.listeningCallbacks.append(open_webapp)
+    # workers prewarm themselves
+    if not args.no_prewarm and workers is None:
+        AlgorithmServer.listeningCallbacks.append(lambda: start_prewarm([
+                spec for spec in registry.specs() if spec.prewarm_at_startup]))
 
+    # wslink serves from the current event loop, jobs hand results over to it
+    eventloop.install()
     server.start(server_args, AlgorithmServer)
     server.stop_webserver()
+    if workers is not None:
+        workers.stop()
@@ -0,0 +1,100 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from transformers import is_itk_image
+
+class SharedVolume(object):
+    '''Picklable handle of an ndarray or ITK image in shared memory.
+
+    The receiving process copies the volume out and unlinks the segment, so
+    a volume crosses the process boundary once, without being pickled.
+    key is the stage cache identity of the volume, if known.
+    '''
+
+    def __init__(self, obj, key=None):
+        import itk
+
+        arr = obj
+        self.geometry = None
+        if is_itk_image(obj):
+            arr = itk.GetArrayViewFromImage(obj)
+            self.geometry = {
+                'origin': list(obj.GetOrigin()),
+                'spacing': list(obj.GetSpacing()),
+                'direction': itk.GetArrayFromMatrix(obj.GetDirection()),
+                'isVector': obj.GetNumberOfComponentsPerPixel() > 1,
+            }
+        self.shape = arr.shape
+        self.dtype = arr.dtype.str
+        self.key = key
+        # segments cannot be empty
+        segment = shared_memory.SharedMemory(create=True,
+                                             size=max(arr.nbytes, 1))
+        self.name = segment.name
+        np.ndarray(arr.shape, arr.dtype, buffer=segment.buf)[...] = arr
+        segment.close()
+
+    def load(self):
+        import itk
+
+        segment = shared_memory.SharedMemory(name=self.name)
+        try:
+            arr = np.ndarray(self.shape, self.dtype, buffer=segment.buf).copy()
+        finally:
+            segment.close()
+            segment.unlink()
+        if self.geometry is None:
+            return arr
+
+        image = itk.GetImageFromArray(arr, is_vector=self.geometry['isVector'])
+        image.SetOrigin(self.geometry['origin'])
+        image.SetSpacing(self.geometry['spacing'])
+        image.SetDirection(itk.GetMatrixFromArray(self.geometry['direction']))
+        return image
+
+    def discard(self):
+        try:
+            segment = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        segment.close()
+        segment.unlink()
+
+def share(obj, key_of=None):
+    '''Replaces the volumes in obj (nested dicts, lists and tuples) with
+    SharedVolume handles. key_of(volume) gives the handles' keys.
+    '''
+    if isinstance(obj, np.ndarray) or is_itk_image(obj):
+        return SharedVolume(obj, key_of(obj) if key_of else None)
+    if isinstance(obj, dict):
+        return {k: share(v, key_of) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(share(v, key_of) for v in obj)
+    return obj
+
+def unshare(obj, identify=None):
+    '''Loads the volumes shared by share(). identify(volume, key) is called
+    for each volume with a key.
+    '''
+    if isinstance(obj, SharedVolume):
+        volume = obj.load()
+        if identify and obj.key is not None:
+            identify(volume, obj.key)
+        return volume
+    if isinstance(obj, dict):
+        return {k: unshare(v, identify) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(unshare(v, identify) for v in obj)
+    return obj
+
+def discard(obj):
+    '''Frees the segments of volumes shared by share() that were not loaded.'''
+    if isinstance(obj, SharedVolume):
+        obj.discard()
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            discard(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            discard(v)
@@ -0,0 +1,116 @@
+import os
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from transformers import is_itk_image
+
+# default size cap of the spill directory
+DEFAULT_SPILL_SIZE = 16 * 2**30
+
+def can_spill(obj):
+    return isinstance(obj, np.ndarray) or is_itk_image(obj)
+
+class SpillDirectory(object):
+    '''A second cache tier keeping evicted volumes on local disk.
+
+    ndarrays and ITK images are written as .npy files, the geometry of
+    images being kept in memory, and are reopened read-only with np.memmap,
+    so reloading a volume only pages in what is read. Once the files exceed
+    max_bytes, the least recently used ones are deleted.
+    '''
+
+    def __init__(self, path, max_bytes=DEFAULT_SPILL_SIZE):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.spills = 0
+        self.loads = 0
+        self.evictions = 0
+        # key -> (filename, nbytes, geometry of images or None)
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def spill(self, key, obj):
+        '''Writes obj to disk. Returns False if obj cannot be spilled.'''
+        import itk
+
+        if key in self._entries:
+            # reloaded volumes are read-only, so the file is still current
+            self._entries.move_to_end(key)
+            return True
+        if not can_spill(obj):
+            return False
+
+        geometry = None
+        arr = obj
+        if is_itk_image(obj):
+            arr = itk.GetArrayViewFromImage(obj)
+            geometry = {
+                'origin': list(obj.GetOrigin()),
+                'spacing': list(obj.GetSpacing()),
+                'direction': itk.GetArrayFromMatrix(obj.GetDirection()),
+                'isVector': obj.GetNumberOfComponentsPerPixel() > 1,
+            }
+        if arr.nbytes > self.max_bytes:
+            return False
+
+        filename = os.path.join(self.path, uuid.uuid4().hex + '.npy')
+        np.save(filename, arr)
+        self._entries[key] = (filename, arr.nbytes, geometry)
+        self.nbytes += arr.nbytes
+        self.spills += 1
+        while self.nbytes > self.max_bytes:
+            self.discard(next(iter(self._entries)))
+            self.evictions += 1
+        return True
+
+    def load(self, key, default=None):
+        '''Reopens a spilled volume, without reading it into memory.'''
+        import itk
+
+        if key not in self._entries:
+            return default
+        self._entries.move_to_end(key)
+        filename, _, geometry = self._entries[key]
+        arr = np.load(filename, mmap_mode='r')
+        self.loads += 1
+        if geometry is None:
+            return arr
+
+        image = itk.GetImageViewFromArray(arr, is_vector=geometry['isVector'])
+        image.SetOrigin(geometry['origin'])
+        image.SetSpacing(geometry['spacing'])
+        image.SetDirection(itk.GetMatrixFromArray(geometry['direction']))
+        return image
+
+    def discard(self, key):
+        if key not in self._entries:
+            return
+        filename, nbytes, _ = self._entries.pop(key)
+        self.nbytes -= nbytes
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def clear(self):
+        for key in list(self._entries.keys()):
+            self.discard(key)
+
+    def stats(self):
+        return {
+            'count': len(self._entries),
+            'bytes': self.nbytes,
+            'maxBytes': self.max_bytes,
+            'spills': self.spills,
+            'loads': self.loads,
+            'evictions': self.evictions,
+        }
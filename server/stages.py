@@ -0,0 +1,96 @@
+import hashlib
+import threading
+import weakref
+
+import numpy as np
+
+from cache import LRUCache
+from jobs import timed_stage
+from transformers import object_nbytes, is_itk_image
+
+# default byte budget of the pipeline stage cache
+DEFAULT_STAGE_CACHE_SIZE = 1 * 2**30
+
+_missing = object()
+
+def content_key(dataset):
+    '''Hashes the pixels and geometry of an ITK image or ndarray.'''
+    import itk
+
+    h = hashlib.blake2b(digest_size=20)
+    if is_itk_image(dataset):
+        arr = itk.GetArrayViewFromImage(dataset)
+        h.update(repr(type(dataset)).encode())
+        for geometry in (dataset.GetOrigin(), dataset.GetSpacing()):
+            h.update(np.asarray(geometry, dtype=np.float64).tobytes())
+        h.update(itk.GetArrayFromMatrix(dataset.GetDirection()).tobytes())
+    else:
+        arr = np.asarray(dataset)
+        h.update(str(arr.dtype).encode())
+    h.update(repr(arr.shape).encode())
+    h.update(memoryview(np.ascontiguousarray(arr)).cast('B'))
+    return h.hexdigest()
+
+class StageCache(object):
+    '''Memoizes the stages of an algorithm pipeline.
+
+    A stage result is keyed by the stage name, the identity of its input
+    datasets and the parameters it depends on. Results are kept in an LRU
+    cache bounded by a byte budget, so that changing a parameter only
+    reruns the stages downstream of it.
+
+    Input datasets are identified by the key given to identify() (e.g. the
+    client's hash of an uploaded dataset), by the stage that produced them,
+    or else by a hash of their content.
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_STAGE_CACHE_SIZE):
+        self._results = LRUCache(max_bytes)
+        self._keys = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def identify(self, dataset, key):
+        '''Records key as the identity of dataset.'''
+        try:
+            with self._lock:
+                self._keys[dataset] = key
+        except TypeError:
+            # not weakly referenceable, identified by content instead
+            pass
+
+    def key_of(self, dataset):
+        with self._lock:
+            try:
+                key = self._keys.get(dataset, None)
+            except TypeError:
+                key = None
+        if key is None:
+            key = content_key(dataset)
+            self.identify(dataset, key)
+        return key
+
+    def run(self, stage, fn, inputs, params=None):
+        '''Returns fn(*inputs, **params), reusing a cached result.
+
+        params holds the parameters fn depends on besides its inputs.
+        '''
+        params = params or {}
+        key = (stage, tuple(self.key_of(i) for i in inputs),
+               tuple(sorted(params.items())))
+        with self._lock:
+            result = self._results.get(key, _missing)
+        if result is _missing:
+            with timed_stage(stage):
+                result = fn(*inputs, **params)
+            with self._lock:
+                self._results.put(key, result, object_nbytes(result))
+        self.identify(result, key)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def stats(self):
+        with self._lock:
+            return self._results.stats()
@@ -0,0 +1,67 @@
+import time
+import threading
+from contextlib import contextmanager
+
+class StartupProfile(object):
+    '''Times the steps from server start to the first algorithm result.
+
+    Milestones are recorded as seconds since the profile was created, which
+    is when server.py starts importing its modules. Steps record their own
+    duration.
+    '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.enabled = False
+        self.milestones = []
+        self.steps = []
+        self._lock = threading.Lock()
+
+    def mark(self, milestone):
+        '''Records a milestone, once. Prints it if profiling is enabled.'''
+        with self._lock:
+            if any(m == milestone for m, _ in self.milestones):
+                return
+            elapsed = time.perf_counter() - self.start
+            self.milestones.append((milestone, elapsed))
+        if self.enabled:
+            print('[startup] {:<56} {:8.3f} s'.format(milestone, elapsed))
+
+    @contextmanager
+    def timed(self, step):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.steps.append((step, time.perf_counter() - start))
+
+    def report(self):
+        lines = ['[startup] {:<56} {:8.3f} s'.format(milestone, elapsed)
+                 for milestone, elapsed in self.milestones]
+        lines += ['[startup]   {:<54} {:8.3f} s'.format(step, seconds)
+                  for step, seconds in self.steps]
+        return '\n'.join(lines)
+
+profile = StartupProfile()
+
+def prewarm(algorithms):
+    '''Imports ITK, then each algorithm and the filters it needs.'''
+    with profile.timed('import itk'):
+        import itk
+    for algorithm in algorithms:
+        algorithm.prewarm()
+    profile.mark('ITK prewarmed')
+    if profile.enabled:
+        print(profile.report())
+
+def start_prewarm(algorithms):
+    '''Runs prewarm(algorithms) in a background thread.
+
+    ITK's lazy loading is guarded by a lock, so calls needing a module that
+    is still loading wait for it rather than load it again.
+    '''
+    thread = threading.Thread(target=prewarm, args=(algorithms,),
+                              name='prewarm', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,145 @@
+import sys
+import time
+import threading
+
+import eventloop
+
+# a channel publishes once this many bytes are buffered...
+FLUSH_BYTES = 4096
+# ...or this many seconds after its first buffered write
+FLUSH_INTERVAL = 0.25
+
+class LogMetrics(object):
+    '''Counts writes and published messages across all log channels.'''
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.writes = 0
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, writes=0, messages=0, nbytes=0):
+        with self._lock:
+            self.writes += writes
+            self.messages += messages
+            self.bytes += nbytes
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return {
+            'writes': self.writes,
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'messagesPerSecond': self.messages / elapsed,
+            'writesPerMessage': self.writes / max(self.messages, 1),
+        }
+
+metrics = LogMetrics()
+
+class LogChannel(object):
+    '''Buffers text written by one handler and publishes it in batches.
+
+    publish(topic, text) is always invoked from the event loop's thread, so
+    a channel may be written to from any thread. A timer armed by the first
+    buffered write publishes output followed by a long silence, such as a
+    message printed before a slow filter.
+    '''
+
+    def __init__(self, publish, topic='streams.stdout',
+                 flush_bytes=FLUSH_BYTES, flush_interval=FLUSH_INTERVAL):
+        self.publish = publish
+        self.topic = topic
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        # delayed flush, only touched from the event loop's thread
+        self._timer = None
+
+    def write(self, text):
+        if not text:
+            return
+        with self._lock:
+            first = not self._buffer
+            self._buffer.append(text)
+            self._nbytes += len(text)
+            full = self._nbytes >= self.flush_bytes
+        metrics.add(writes=1)
+
+        if full:
+            self.flush()
+        elif first:
+            eventloop.call_from_thread(self._arm_timer)
+
+    def flush(self):
+        with self._lock:
+            if not self._buffer:
+                return
+            text = ''.join(self._buffer)
+            self._buffer = []
+            self._nbytes = 0
+        metrics.add(messages=1, nbytes=len(text))
+        eventloop.call_from_thread(self._cancel_timer)
+        eventloop.call_from_thread(self.publish, self.topic, text)
+
+    def close(self):
+        '''Publishes what is left and stops the timer.'''
+        self.flush()
+        eventloop.call_from_thread(self._cancel_timer)
+
+    def _arm_timer(self):
+        if self._timer is None:
+            self._timer = eventloop.call_later(self.flush_interval,
+                                               self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = None
+
+class StdoutRouter(object):
+    '''A sys.stdout replacement that tees writes to per-thread channels.
+
+    Everything still reaches the original stdout. Writes made while a
+    thread has routed a channel are also sent to that channel.
+    '''
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self._local = threading.local()
+
+    def route(self, channel):
+        '''Routes the calling thread's writes to channel (None to stop).
+
+        Returns the previously routed channel.
+        '''
+        previous = getattr(self._local, 'channel', None)
+        self._local.channel = channel
+        return previous
+
+    def write(self, text):
+        channel = getattr(self._local, 'channel', None)
+        if channel is not None:
+            channel.write(text)
+        return self.stdout.write(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+_router_lock = threading.Lock()
+
+def stdout_router():
+    '''Installs a StdoutRouter as sys.stdout, once, and returns it.'''
+    with _router_lock:
+        if not isinstance(sys.stdout, StdoutRouter):
+            sys.stdout = StdoutRouter(sys.stdout)
+        return sys.stdout
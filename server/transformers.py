@@ -1,11 +1,11 @@
 import sys
-import struct
 import random
 
 import numpy as np
-import itk
 
 from serializable import serializer, unserializer
+from array_codecs import decode
+from chunking import is_chunked, join_chunks
 
 def print_matrix(itkmat, size=(3, 3)):
     for i in range(size[0]):
@@ -13,8 +13,27 @@ def print_matrix(itkmat, size=(3, 3)):
             sys.stdout.write('{} '.format(itkmat(i, j)))
         sys.stdout.write('\n')
 
+def is_itk_image_type(cls):
+    return cls.__name__.startswith('itkImage')
+
 def is_itk_image(o):
-    return type(o).__name__.startswith('itkImage')
+    return is_itk_image_type(type(o))
+
+def object_nbytes(o):
+    '''Approximate memory held by pixel buffers reachable from o.'''
+    import itk
+
+    if is_itk_image(o):
+        return itk.GetArrayViewFromImage(o).nbytes
+    if isinstance(o, np.ndarray):
+        return o.nbytes
+    if isinstance(o, (bytes, bytearray, memoryview)):
+        return len(o)
+    if isinstance(o, dict):
+        return sum(object_nbytes(v) for v in o.values())
+    if isinstance(o, (list, tuple)):
+        return sum(object_nbytes(v) for v in o)
+    return 0
 
 # modified from: https://github.com/InsightSoftwareConsortium/itk-jupyter-widgets/blob/master/itkwidgets/trait_types.py#L49
 def _itk_image_to_type(itkimage):
@@ -72,48 +91,60 @@ def _itk_image_to_type(itkimage):
     }
     return _python_to_js[mangle]
 
+# explicit little-endian dtypes, since vtk.js typed arrays are sent as-is
+# from the (little-endian) browser
+JS_TO_NUMPY_DTYPE = {
+    'Int8Array': np.dtype('<i1'),
+    'Int16Array': np.dtype('<i2'),
+    'Int32Array': np.dtype('<i4'),
+    'Uint8Array': np.dtype('<u1'),
+    'Uint16Array': np.dtype('<u2'),
+    'Uint32Array': np.dtype('<u4'),
+    'Float32Array': np.dtype('<f4'),
+    'Float64Array': np.dtype('<f8'),
+}
+
 def _vtkjs_type_convert(blob, jstype):
-    js_to_py_type = {
-        'Int8Array': {
-            'struct': (1, 'b'),
-            'dtype': 'int8',
-        },
-        'Int16Array': {
-            'struct': (2, 'h'),
-            'dtype': 'int16',
-        },
-        'Int32Array': {
-            'struct': (4, 'i'),
-            'dtype': 'int32',
-        },
-        'Uint8Array': {
-            'struct': (1, 'B'),
-            'dtype': 'uint8',
-        },
-        'Uint16Array': {
-            'struct': (2, 'H'),
-            'dtype': 'uint16',
-        },
-        'Uint32Array': {
-            'struct': (4, 'I'),
-            'dtype': 'uint32',
-        },
-        'Float32Array': {
-            'struct': (4, 'f'),
-            'dtype': 'float32',
-        },
-        'Float64Array': {
-            'struct': (8, 'd'),
-            'dtype': 'float64',
-        },
-    }
+    '''Views a vtk.js typed array blob as a numpy array.
+
+    No copy is made on little-endian hosts; the returned array shares memory
+    with the blob and is read-only if the blob is immutable (e.g. bytes).
+    Chunked blobs are reassembled into a single preallocated array, and
+    encoded blobs are decoded with their codec.
+    '''
+    dtype = JS_TO_NUMPY_DTYPE[jstype]
+    if is_chunked(blob):
+        codec = blob.get('codec', 'none')
+        chunks = (decode(codec, c, dtype) for c in blob['chunks'])
+        arr = join_chunks(chunks, dtype, blob.get('byteLength', None))
+    elif type(blob) is dict and blob.get('classType') == 'ArrayBuffer':
+        data = decode(blob.get('codec', 'none'), blob['buffer'], dtype)
+        arr = np.frombuffer(data, dtype=dtype)
+    else:
+        # sanity
+        assert len(blob) % dtype.itemsize == 0
+        arr = np.frombuffer(blob, dtype=dtype)
+    if not arr.dtype.isnative:
+        arr = arr.astype(arr.dtype.newbyteorder('='))
+    return arr
 
-    size, fmt = js_to_py_type[jstype]['struct']
-    dtype = np.dtype(js_to_py_type[jstype]['dtype'])
-    # sanity
-    assert len(blob) % size == 0
-    full_fmt = '<{0}{1}'.format(int(len(blob) / size), fmt)
-    return np.array(struct.unpack(full_fmt, blob), dtype=dtype, copy=False)
+class ImageBufferView(np.ndarray):
+    '''An ndarray view of an ITK pixel buffer that keeps its image alive.'''
+    pass
+
+def _flat_view_from_image(itk_image):
+    '''Returns a flat, zero-copy view of the image's pixel container.
+
+    The view holds a reference to the image, so the pixel buffer outlives
+    the image's other owners for as long as the view (or a memoryview of it,
+    e.g. a pending attachment) is alive.
+    '''
+    import itk
+
+    view = itk.GetArrayViewFromImage(itk_image).ravel(order='C')
+    view = view.view(ImageBufferView)
+    view.itk_image = itk_image
+    return view
 
 def unpack_data_arrays(vtk_obj):
     if isinstance(vtk_obj, list):
@@ -131,15 +162,17 @@ def unpack_data_arrays(vtk_obj):
 # Serializers #
 ###############
 
-@serializer(lambda k, v: is_itk_image(v))
+@serializer(types=is_itk_image_type)
 def itk_to_vtk_image(key, itk_image):
+    import itk
+
     dims = list(itk_image.GetLargestPossibleRegion().GetSize())
     extent = []
     for v in dims:
         extent.append(0)
         extent.append(v - 1)
 
-    values = itk.GetArrayFromImage(itk_image).flatten(order='C')
+    values = _flat_view_from_image(itk_image)
 
     return {
         'vtkClass': 'vtkImageData',
@@ -155,24 +188,65 @@ def itk_to_vtk_image(key, itk_image):
         },
     }
 
-@serializer(lambda k, v: type(v).__name__ == 'itkTubeSpatialObject3')
+def is_tube_type(cls):
+    return cls.__name__ == 'itkTubeSpatialObject3'
+
+def _point_row(point):
+    position = point.GetPositionInObjectSpace()
+    # indexing is much faster than iterating over an itk.Point
+    return (position[0], position[1], position[2],
+            point.GetRadiusInObjectSpace())
+
+def _tube_columns(tubes):
+    '''Gathers the points of tubes into columnar arrays.
+
+    Returns (offsets, positions, radii): the points of tube i are rows
+    offsets[i]:offsets[i+1] of the Nx3 positions and N radii arrays.
+
+    ITK does not expose tube points as a buffer, so the points of each
+    tube are fetched at once with GetPoints and copied in bulk into a
+    preallocated table.
+    '''
+    counts = [tube.GetNumberOfPoints() for tube in tubes]
+    offsets = np.zeros(len(tubes) + 1, dtype=np.uint32)
+    np.cumsum(counts, out=offsets[1:])
+
+    table = np.empty((offsets[-1], 4), dtype=np.float32)
+    for tube, start, end in zip(tubes, offsets, offsets[1:]):
+        if end > start:
+            table[start:end] = [_point_row(p) for p in tube.GetPoints()]
+    return offsets, np.ascontiguousarray(table[:, :3]), table[:, 3].copy()
+
+@serializer(types=is_tube_type)
 def serialize_tube(key, tube):
-    tube_points = []
-    for i in range(tube.GetNumberOfPoints()):
-        point = tube.GetPoint(i)
-        tube_points.append({
-            'point': list(point.GetPositionInObjectSpace()),
-            'radius': point.GetRadiusInObjectSpace(),
-        })
+    _, positions, radii = _tube_columns([tube])
 
     return {
+        'classType': 'Tube',
         'id': tube.GetId(),
-        'points': tube_points,
         'color': list(tube.GetProperty().GetColor()),
         'parent': tube.GetParentId(),
+        'positions': positions.ravel(),
+        'radii': radii,
     }
 
-@serializer(lambda k, v: v['vtkClass'] == 'vtkLabelMap')
+@serializer(lambda k, v: len(v) > 0 and all(is_tube_type(type(t)) for t in v),
+            types=(list, tuple))
+def serialize_tube_group(key, tubes):
+    '''Serializes a list of tubes as one set of columnar arrays.'''
+    offsets, positions, radii = _tube_columns(tubes)
+
+    return {
+        'classType': 'TubeGroup',
+        'ids': [tube.GetId() for tube in tubes],
+        'colors': [list(tube.GetProperty().GetColor()) for tube in tubes],
+        'parents': [tube.GetParentId() for tube in tubes],
+        'offsets': offsets,
+        'positions': positions.ravel(),
+        'radii': radii,
+    }
+
+@serializer(lambda k, v: v.get('vtkClass') == 'vtkLabelMap', types=(dict,))
 def serialize_labelmap(key, labelmap):
     labelmap['imageRepresentation'] = itk_to_vtk_image(key, labelmap['imageRepresentation'])
     return labelmap
@@ -181,8 +255,10 @@ def serialize_labelmap(key, labelmap):
 # Unserializers #
 #################
 
-@unserializer(lambda k, v: v['vtkClass'] == 'vtkImageData')
+@unserializer(lambda k, v: v.get('vtkClass') == 'vtkImageData', types=(dict,))
 def vtk_to_itk_image(key, vtk_image):
+    import itk
+
     pixel_data = vtk_image['pointData']['values']
     pixel_type = vtk_image['pointData']['dataType']
 
@@ -200,7 +276,8 @@ def vtk_to_itk_image(key, vtk_image):
         for y in range(3):
             direction[x][y] = vtk_image['direction'][x*3+y]
 
-    itkImage = itk.GetImageFromArray(np.reshape(pixel_data, dims))
+    # view the attachment buffer in place rather than copying it into ITK
+    itkImage = itk.GetImageViewFromArray(np.reshape(pixel_data, dims))
     # https://discourse.itk.org/t/set-image-direction-from-numpy-array/844/10
     vnlmat = itk.GetVnlMatrixFromArray(direction)
     itkImage.GetDirection().GetVnlMatrix().copy_in(vnlmat.data_block())
@@ -209,7 +286,7 @@ def vtk_to_itk_image(key, vtk_image):
 
     return itkImage
 
-@unserializer(lambda k, v: v['vtkClass'] == 'vtkLabelMap')
+@unserializer(lambda k, v: v.get('vtkClass') == 'vtkLabelMap', types=(dict,))
 def unserialize_labelmap(key, labelmap):
     labelmap['imageRepresentation'] = vtk_to_itk_image(key, labelmap['imageRepresentation'])
     return labelmap
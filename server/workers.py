@@ -0,0 +1,308 @@
+import sys
+import traceback
+import threading
+import multiprocessing
+
+from jobs import (JobRunner, JobCancelled, current_job, configure_itk_threads,
+                  DEFAULT_MAX_THREADS)
+from metrics import peak_rss
+from stages import DEFAULT_STAGE_CACHE_SIZE
+
+# default number of worker processes; 0 runs algorithms in the server process
+DEFAULT_WORKERS = 0
+
+# default peak resident memory of a worker after which it is replaced
+DEFAULT_MAX_WORKER_RSS = 8 * 2**30
+
+# seconds between two cancellation checks while waiting on a worker
+POLL_INTERVAL = 0.1
+
+class WorkerCrashed(Exception):
+    pass
+
+class _PipeWriter(object):
+    '''Sends what a worker prints to the front end.'''
+
+    def __init__(self, send):
+        self.send = send
+
+    def write(self, text):
+        if text:
+            self.send(('stdout', text))
+
+    def flush(self):
+        pass
+
+def worker_main(conn, threads, stage_cache_size, algorithms_dirs, prewarm):
+    '''Entry point of a worker process.
+
+    Runs the algorithms of the registry for the front end, one call at a
+    time, and sends back their output, progress, partial and final results.
+    '''
+    from registry import AlgorithmApi, registry
+    from startup import start_prewarm
+    from shm import share, unshare
+
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    class WorkerApi(AlgorithmApi):
+        def publish_partial(self, retval, **info):
+            send(('partial', share(retval), info))
+
+    sys.stdout = _PipeWriter(send)
+    registry.load(algorithms_dirs)
+    configure_itk_threads(threads)
+    if prewarm:
+        start_prewarm([spec for spec in registry.specs()
+                       if spec.prewarm_at_startup])
+
+    api = WorkerApi(stage_cache_size=stage_cache_size, max_threads=threads)
+    runner = JobRunner(max_threads=threads, report_progress=lambda job_id,
+                       stage, progress: send(('progress', stage, progress)))
+    state = {'job': None, 'cancelled': False}
+
+    def run(algorithm, params):
+        def target(params):
+            job = current_job()
+            state['job'] = job
+            if state['cancelled']:
+                job.cancel()
+            return api.algorithm(algorithm).run(params)
+
+        job = None
+        try:
+            params = unshare(params, api.stages.identify)
+            result, job = runner.run_now(target, params)
+            send(('result', share(result), job.timings, peak_rss()))
+        except Exception as e:
+            if not isinstance(e, JobCancelled):
+                traceback.print_exc(file=sys.__stderr__)
+            timings = state['job'].timings if state['job'] else []
+            send(('error', str(e), timings, peak_rss()))
+        finally:
+            state['job'] = None
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message[0] == 'run':
+            state['cancelled'] = False
+            threading.Thread(target=run, args=message[1:], name='job',
+                             daemon=True).start()
+        elif message[0] == 'cancel':
+            state['cancelled'] = True
+            if state['job'] is not None:
+                state['job'].cancel()
+        elif message[0] == 'reset':
+            api.stages.clear()
+        elif message[0] == 'stop':
+            break
+
+class Worker(object):
+    '''A worker process of a WorkerPool, and the sessions assigned to it.
+
+    The process is started on the first call, and restarted on the call
+    following a crash or a recycling.
+    '''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.sessions = set()
+        self.calls = 0
+        self.starts = 0
+        self.peak_rss = 0
+        self.process = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process is not None else None
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        conn, child_conn = context.Pipe()
+        self.process = context.Process(
+                target=worker_main, name='algorithm-worker', daemon=True,
+                args=(child_conn, self.pool.threads,
+                      self.pool.stage_cache_size, self.pool.algorithms_dirs,
+                      self.pool.prewarm))
+        self.process.start()
+        child_conn.close()
+        self._conn = conn
+        self.peak_rss = 0
+        self.starts += 1
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self._conn.send(('stop',))
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self._conn.close()
+        self.process = None
+
+    def reset(self):
+        '''Frees the stage results of the previous sessions, unless busy.'''
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self.process is not None:
+                self._conn.send(('reset',))
+        except OSError:
+            pass
+        finally:
+            self._lock.release()
+
+    def run(self, algorithm, params, key_of=None, publish_partial=None):
+        '''Runs an algorithm in the worker process.
+
+        Called from a job thread of the front end, whose job receives the
+        worker's progress, stage timings and cancellation. The worker's
+        output is printed, and its partial results are passed to
+        publish_partial. Volumes of params and results go through shared
+        memory; key_of(volume) gives the stage cache identity of inputs.
+        '''
+        # shared memory needs Python 3.8, only imported with workers
+        from shm import share, discard
+
+        job = current_job()
+        with self._lock:
+            if self.process is None or not self.process.is_alive():
+                self.start()
+            self.calls += 1
+            shared = share(params, key_of)
+            try:
+                self._conn.send(('run', algorithm, shared))
+                return self._wait(job, publish_partial)
+            except (EOFError, OSError):
+                self.process.join(1)
+                exitcode = self.process.exitcode
+                self.stop()
+                self.pool.crashes += 1
+                raise WorkerCrashed(
+                        'Worker process exited unexpectedly (exit code {})'
+                        .format(exitcode))
+            finally:
+                discard(shared)
+                if self.process is not None and \
+                        self.peak_rss > self.pool.max_rss:
+                    self.stop()
+                    self.pool.recycles += 1
+
+    def _wait(self, job, publish_partial):
+        from shm import unshare
+
+        cancel_sent = False
+        while True:
+            if not self._conn.poll(POLL_INTERVAL):
+                if job is not None and job.cancelled and not cancel_sent:
+                    self._conn.send(('cancel',))
+                    cancel_sent = True
+                continue
+
+            message = self._conn.recv()
+            kind = message[0]
+            if kind == 'stdout':
+                sys.stdout.write(message[1])
+            elif kind == 'progress':
+                if job is not None:
+                    job.progress(*message[1:])
+            elif kind == 'partial':
+                retval = unshare(message[1])
+                if publish_partial is not None:
+                    publish_partial(retval, **message[2])
+            elif kind in ('result', 'error'):
+                _, retval, timings, self.peak_rss = message
+                if job is not None:
+                    job.timings.extend(timings)
+                if kind == 'error':
+                    if job is not None:
+                        job.check_cancelled()
+                    raise Exception(retval)
+                return unshare(retval)
+
+class WorkerPool(object):
+    '''A bounded pool of processes running algorithms for the sessions.
+
+    Each session is assigned a worker process, which keeps the session's
+    stage results, so that one session's crash or memory blow-up does not
+    take down the others. Sessions get an idle worker if there is one,
+    else a new one while fewer than size run, else share the least busy
+    worker. Workers are reused once their sessions close, and replaced
+    after a call leaves their peak resident memory above max_rss.
+    '''
+
+    def __init__(self, size, max_rss=DEFAULT_MAX_WORKER_RSS, threads=None,
+                 stage_cache_size=DEFAULT_STAGE_CACHE_SIZE,
+                 algorithms_dirs=(), prewarm=True):
+        self.size = size
+        self.max_rss = max_rss
+        self.threads = threads or max(1, DEFAULT_MAX_THREADS // size)
+        self.stage_cache_size = stage_cache_size
+        self.algorithms_dirs = list(algorithms_dirs)
+        self.prewarm = prewarm
+        self.crashes = 0
+        self.recycles = 0
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def acquire(self, session):
+        '''The worker assigned to session, assigning one if needed.
+
+        session identifies a client, such as its wslink client id.
+        '''
+        with self._lock:
+            for worker in self._workers:
+                if session in worker.sessions:
+                    return worker
+            idle = [w for w in self._workers if not w.sessions]
+            if idle:
+                worker = idle[0]
+            elif len(self._workers) < self.size:
+                worker = Worker(self)
+                self._workers.append(worker)
+            else:
+                worker = min(self._workers, key=lambda w: len(w.sessions))
+            worker.sessions.add(session)
+            return worker
+
+    def release(self, session):
+        with self._lock:
+            for worker in self._workers:
+                if session in worker.sessions:
+                    worker.sessions.discard(session)
+                    if not worker.sessions:
+                        worker.reset()
+
+    def stop(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.stop()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'maxRss': self.max_rss,
+                'crashes': self.crashes,
+                'recycles': self.recycles,
+                'workers': [{
+                    'pid': w.pid,
+                    'sessions': len(w.sessions),
+                    'calls': w.calls,
+                    'starts': w.starts,
+                    'peakRss': w.peak_rss,
+                } for w in self._workers],
+            }
@@ -19,25 +19,32 @@ export default {
       connected: 'connected',
       processing: 'processing',
       serverStdout: 'serverStdout',
+      jobId: 'jobId',
+      jobProgress: 'jobProgress',
+      algorithms: 'algorithms',
+      algorithm: 'algorithm',
       parameters: (state) => state.paramOrder.map((name) => state.params[name]),
     }),
   },
   mounted() {
-    this.fetchParamList().catch(() => {
-      this.error = 'Failed to fetch parameter list';
-    });
+    this.fetchAlgorithmList()
+      .then(() => this.fetchParamList())
+      .catch(() => {
+        this.error = 'Failed to fetch parameter list';
+      });
   },
   methods: {
     run() {
       this.error = '';
-      this.runRemoteAlgorithm()
-        .then((results) => {
-          if (results.datasets) {
-            results.datasets.forEach((datasetInfo) =>
-              this.registerDataset(datasetInfo)
-            );
-          }
-        })
+      const registerResults = (results) => {
+        if (results.datasets) {
+          results.datasets.forEach((datasetInfo) =>
+            this.registerDataset(datasetInfo)
+          );
+        }
+      };
+      this.runRemoteAlgorithm({ onPartialResult: registerResults })
+        .then(registerResults)
         .catch((error) => {
           this.error = error.data.exception;
         });
@@ -63,8 +70,11 @@ export default {
     },
 
     ...mapActions('remote', {
+      fetchAlgorithmList: 'fetchAlgorithmList',
       fetchParamList: 'fetchParamList',
+      selectAlgorithm: 'selectAlgorithm',
       runRemoteAlgorithm: 'runRemoteAlgorithm',
+      cancel: 'cancelRemoteAlgorithm',
       clearOutput: 'clearStdout',
       setParameter: (dispatch, name, value) => {
         dispatch('setParameter', { name, value });
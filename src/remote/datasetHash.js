@@ -0,0 +1,73 @@
+// dataset -> { mtime, hash }
+const hashCache = new WeakMap();
+
+function toHex(buffer) {
+  return Array.from(new Uint8Array(buffer))
+    .map((b) => b.toString(16).padStart(2, '0'))
+    .join('');
+}
+
+function getImage(dataset) {
+  if (dataset.isA('vtkLabelMap')) {
+    return dataset.getImageRepresentation();
+  }
+  return dataset;
+}
+
+/**
+ * Computes a content hash of an image dataset (pixels + geometry).
+ *
+ * Resolves to null if the dataset cannot be hashed, e.g. when
+ * crypto.subtle is unavailable in insecure contexts.
+ */
+export function hashDataset(dataset) {
+  const subtle = window.crypto && window.crypto.subtle;
+  if (!subtle || !dataset || !dataset.isA) {
+    return Promise.resolve(null);
+  }
+
+  const image = getImage(dataset);
+  if (!image || !image.isA('vtkImageData')) {
+    return Promise.resolve(null);
+  }
+
+  const scalars = image.getPointData().getScalars();
+  const mtime = Math.max(
+    dataset.getMTime(),
+    image.getMTime(),
+    scalars.getMTime()
+  );
+
+  const cached = hashCache.get(dataset);
+  if (cached && cached.mtime === mtime) {
+    return Promise.resolve(cached.hash);
+  }
+
+  const header = JSON.stringify({
+    origin: Array.from(image.getOrigin()),
+    spacing: Array.from(image.getSpacing()),
+    direction: Array.from(image.getDirection()),
+    extent: Array.from(image.getExtent()),
+    dataType: scalars.getDataType(),
+    numberOfComponents: scalars.getNumberOfComponents(),
+    colorMap: dataset.isA('vtkLabelMap') ? dataset.getColorMap() : null,
+  });
+
+  return subtle
+    .digest('SHA-256', scalars.getData())
+    .then((pixelDigest) =>
+      subtle.digest(
+        'SHA-256',
+        new TextEncoder().encode(`${header}:${toHex(pixelDigest)}`)
+      )
+    )
+    .then((digest) => {
+      const hash = toHex(digest);
+      hashCache.set(dataset, { mtime, hash });
+      return hash;
+    });
+}
+
+export default {
+  hashDataset,
+};
@@ -27,23 +27,161 @@ const TypeConversions = generateConversionLookup([
   { js: 'Float64Array', numpy: 'float64' },
 ]);
 
+// Typed arrays larger than this are sent as multiple attachments
+const MAX_CHUNK_SIZE = 16 * 1024 * 1024;
+
+// Integer arrays with fewer runs per element than this are uploaded with rle
+const RLE_MAX_RUN_RATE = 1 / 32;
+
+const IntegerArrayTypes = [
+  Int8Array,
+  Uint8Array,
+  Int16Array,
+  Uint16Array,
+  Int32Array,
+  Uint32Array,
+];
+
+// codecs this client can decode, sent to the server on connect
+const SupportedCodecs = ['none', 'rle'].concat(
+  typeof DecompressionStream !== 'undefined' ? ['zlib'] : []
+);
+
+function readBlob(blob) {
+  return new Promise((resolve, reject) => {
+    const fileReader = new FileReader();
+    fileReader.onload = (event) => resolve(event.target.result);
+    fileReader.onerror = (event) => reject(event.error);
+    fileReader.readAsArrayBuffer(blob);
+  });
+}
+
+function countRuns(array) {
+  let runs = array.length ? 1 : 0;
+  for (let i = 1; i < array.length; i++) {
+    if (array[i] !== array[i - 1]) {
+      runs++;
+    }
+  }
+  return runs;
+}
+
+// uint32 run lengths followed by the run values
+function encodeRle(array) {
+  const runs = countRuns(array);
+  const lengths = new Uint32Array(runs);
+  const values = new array.constructor(runs);
+  let run = -1;
+  for (let i = 0; i < array.length; i++) {
+    if (i === 0 || array[i] !== array[i - 1]) {
+      run++;
+      values[run] = array[i];
+    }
+    lengths[run]++;
+  }
+
+  const out = new Uint8Array(runs * (4 + array.BYTES_PER_ELEMENT));
+  out.set(new Uint8Array(lengths.buffer), 0);
+  out.set(new Uint8Array(values.buffer), lengths.byteLength);
+  return out;
+}
+
+function decodeRle(buffer, ArrayType) {
+  const runs = buffer.byteLength / (4 + ArrayType.BYTES_PER_ELEMENT);
+  const lengths = new Uint32Array(buffer, 0, runs);
+  // copy, as the values may not be aligned for ArrayType
+  const values = new ArrayType(buffer.slice(4 * runs));
+
+  const array = new ArrayType(lengths.reduce((total, n) => total + n, 0));
+  let offset = 0;
+  for (let i = 0; i < runs; i++) {
+    array.fill(values[i], offset, offset + lengths[i]);
+    offset += lengths[i];
+  }
+  return array;
+}
+
+// resolves to a typed array of ArrayType
+function decodeBuffer(codec, buffer, ArrayType) {
+  if (codec === 'rle') {
+    return Promise.resolve(decodeRle(buffer, ArrayType));
+  }
+  if (codec === 'zlib') {
+    const stream = new Blob([buffer])
+      .stream()
+      .pipeThrough(new DecompressionStream('deflate'));
+    return new Response(stream)
+      .arrayBuffer()
+      .then((decoded) => new ArrayType(decoded));
+  }
+  return Promise.resolve(new ArrayType(buffer));
+}
+
 function blobToTypedArray(key, value) {
   if (value && value.classType === 'ArrayBuffer') {
-    const { dataType, buffer: blob } = value;
-    const type = TypeConversions[dataType].js;
+    const { dataType, buffer: blob, codec = 'none' } = value;
+    const ArrayType = window[TypeConversions[dataType].js];
 
-    return new Promise((resolve, reject) => {
-      const fileReader = new FileReader();
-      fileReader.onload = (event) => {
-        resolve(new window[type](event.target.result));
-      };
-      fileReader.onerror = (event) => reject(event.error);
-      fileReader.readAsArrayBuffer(blob);
-    });
+    return readBlob(blob).then((buffer) =>
+      decodeBuffer(codec, buffer, ArrayType)
+    );
+  }
+  if (value && value.classType === 'ChunkedArrayBuffer') {
+    const { dataType, byteLength, chunks, codec = 'none' } = value;
+    const ArrayType = window[TypeConversions[dataType].js];
+    const array = new ArrayType(byteLength / ArrayType.BYTES_PER_ELEMENT);
+
+    // decode one chunk at a time straight into the preallocated array
+    let offset = 0;
+    return chunks
+      .reduce(
+        (previous, blob) =>
+          previous
+            .then(() => readBlob(blob))
+            .then((buffer) => decodeBuffer(codec, buffer, ArrayType))
+            .then((chunk) => {
+              array.set(chunk, offset);
+              offset += chunk.length;
+            }),
+        Promise.resolve()
+      )
+      .then(() => array);
   }
   return value;
 }
 
+function attachTypedArray(session, array) {
+  const useRle =
+    IntegerArrayTypes.includes(array.constructor) &&
+    countRuns(array) < RLE_MAX_RUN_RATE * array.length;
+  const codec = useRle ? 'rle' : 'none';
+  const attach = (view) =>
+    session.addAttachment(useRle ? encodeRle(view) : view);
+
+  if (array.byteLength > MAX_CHUNK_SIZE) {
+    const step = Math.floor(MAX_CHUNK_SIZE / array.BYTES_PER_ELEMENT);
+    const chunks = [];
+    for (let start = 0; start < array.length; start += step) {
+      chunks.push(attach(array.subarray(start, start + step)));
+    }
+    return {
+      classType: 'ChunkedArrayBuffer',
+      codec,
+      byteLength: array.byteLength,
+      chunks,
+    };
+  }
+  if (useRle) {
+    return {
+      classType: 'ArrayBuffer',
+      codec,
+      byteLength: array.byteLength,
+      buffer: attach(array),
+    };
+  }
+  return session.addAttachment(array.buffer);
+}
+
 function defer() {
   let resolve;
   let reject;
@@ -61,7 +199,7 @@ function defer() {
 function addCallback(arr, cb) {
   arr.push(cb);
   return () => {
-    const idx = arr.findIndex(cb);
+    const idx = arr.indexOf(cb);
     if (idx > -1) {
       arr.splice(idx, 1);
     }
@@ -77,28 +215,53 @@ function Remote() {
     readyCallbacks: [],
     closeCallbacks: [],
     errorCallbacks: [],
+    partialResultCallbacks: [],
+    deferredCallbacks: [],
     deferredWaitlist: new Map(),
   };
 }
 
 // handles return results
-function handleResult(result) {
+// reply is set for the reply to one of our calls, and unset for results
+// published on defer.results.
+function handleResult(result, reply = false) {
   if (result) {
-    const { data, deferredId } = result;
+    const { data, deferredId, error } = result;
     let deferred = null;
 
+    if (deferredId && reply) {
+      // the server accepted our deferred call
+      deferred = defer();
+      this.priv.deferredWaitlist.set(deferredId, deferred);
+      this.priv.deferredCallbacks.forEach((cb) => cb(deferredId));
+      return deferred.promise;
+    }
+
+    if (deferredId && !this.priv.deferredWaitlist.has(deferredId)) {
+      // not one of our calls, or already finished
+      return Promise.resolve(null);
+    }
+
+    if (deferredId && result.partial) {
+      // intermediate results of a deferred call still running
+      return serializable.revert(data, blobToTypedArray).then((obj) => {
+        // drop partial results that arrive after the final one
+        if (this.priv.deferredWaitlist.has(deferredId)) {
+          this.priv.partialResultCallbacks.forEach((cb) =>
+            cb(obj, result, deferredId)
+          );
+        }
+        return obj;
+      });
+    }
+
     if (deferredId) {
-      if (data && this.priv.deferredWaitlist.has(deferredId)) {
-        deferred = this.priv.deferredWaitlist.get(deferredId);
-        this.priv.deferredWaitlist.delete(deferredId);
-      } else if (!data) {
-        deferred = defer();
-        this.priv.deferredWaitlist.set(deferredId, deferred);
+      deferred = this.priv.deferredWaitlist.get(deferredId);
+      this.priv.deferredWaitlist.delete(deferredId);
+      if (error) {
+        // same shape as errors from regular wslink calls
+        deferred.reject({ data: { exception: error } });
         return deferred.promise;
-      } else {
-        return Promise.reject(
-          new Error('Received deferred data, but no consumers')
-        );
       }
     }
 
@@ -134,6 +297,9 @@ Remote.prototype.connect = function connect(endpoint) {
         // handle deferred results
         this.session.subscribe('defer.results', handleResult.bind(this));
 
+        // servers without compression support just send raw attachments
+        this.call('set_codecs', SupportedCodecs).catch(() => {});
+
         resolve(this.session);
       });
 
@@ -162,7 +328,7 @@ Remote.prototype.call = function call(rpcEndpoint, ...args) {
     const preparedArgs = args.map((arg) => {
       const attachTypedArrays = (key, value) => {
         if (!Array.isArray(value) && ArrayBuffer.isView(value)) {
-          return this.session.addAttachment(value.buffer);
+          return attachTypedArray(this.session, value);
         }
         return value;
       };
@@ -175,7 +341,7 @@ Remote.prototype.call = function call(rpcEndpoint, ...args) {
 
     Promise.all(preparedArgs)
       .then((newArgs) => this.session.call(rpcEndpoint, newArgs))
-      .then(handleResult.bind(this))
+      .then((result) => handleResult.call(this, result, true))
       .then(resolve)
       .catch(reject);
   });
@@ -189,6 +355,15 @@ Remote.prototype.onClose = function onClose(cb) {
   addCallback(this.priv.closeCallbacks, cb);
 };
 
+Remote.prototype.onPartialResult = function onPartialResult(cb) {
+  return addCallback(this.priv.partialResultCallbacks, cb);
+};
+
+// called with the deferredId (job id) of each deferred call once accepted
+Remote.prototype.onDeferredCall = function onDeferredCall(cb) {
+  return addCallback(this.priv.deferredCallbacks, cb);
+};
+
 Remote.prototype.onError = function onError(cb) {
   addCallback(this.priv.errorCallbacks, cb);
 };
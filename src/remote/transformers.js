@@ -88,3 +88,20 @@ function toVtkLabelMap(key, value) {
   return undefined;
 }
 registerReviver(toVtkLabelMap);
+
+function toTubes(key, value) {
+  if (value && value.classType === 'TubeGroup') {
+    const { ids, colors, parents, offsets, positions, radii } = value;
+    // tubes are views into the shared columnar arrays
+    return ids.map((id, i) => ({
+      classType: 'Tube',
+      id,
+      color: colors[i],
+      parent: parents[i],
+      positions: positions.subarray(3 * offsets[i], 3 * offsets[i + 1]),
+      radii: radii.subarray(offsets[i], offsets[i + 1]),
+    }));
+  }
+  return undefined;
+}
+registerReviver(toTubes);
@@ -1,4 +1,5 @@
 import { wrapMutationAsAction } from 'paraview-glance/src/utils';
+import { hashDataset } from 'paraview-glance/src/remote/datasetHash';
 
 const ParamDefaults = {
   source: -1,
@@ -13,9 +14,13 @@ export default ({ proxyManager, remote }) => ({
     connected: false,
     connectError: null,
     processing: false,
+    algorithms: [],
+    algorithm: null,
     params: {},
     paramOrder: [],
     serverStdout: '',
+    jobId: null,
+    jobProgress: null,
   }),
 
   mutations: {
@@ -28,6 +33,15 @@ export default ({ proxyManager, remote }) => ({
     connectError(state, error) {
       state.connectError = error;
     },
+    loadAlgorithms(state, algorithms) {
+      state.algorithms = algorithms;
+      if (!algorithms.find((a) => a.name === state.algorithm)) {
+        state.algorithm = algorithms.length ? algorithms[0].name : null;
+      }
+    },
+    selectAlgorithm(state, name) {
+      state.algorithm = name;
+    },
     loadParams(state, params) {
       const paramMap = {};
       params.forEach((param) => {
@@ -42,6 +56,16 @@ export default ({ proxyManager, remote }) => ({
     },
     processing(state, flag) {
       state.processing = flag;
+      if (!flag) {
+        state.jobId = null;
+        state.jobProgress = null;
+      }
+    },
+    setJobId(state, jobId) {
+      state.jobId = jobId;
+    },
+    setJobProgress(state, progress) {
+      state.jobProgress = progress;
     },
     appendStdout(state, text) {
       state.serverStdout += text;
@@ -52,7 +76,7 @@ export default ({ proxyManager, remote }) => ({
   },
 
   actions: {
-    connect({ commit }, endpoint) {
+    connect({ state, commit }, endpoint) {
       remote.onClose(() => commit('disconnected'));
 
       return remote
@@ -62,11 +86,26 @@ export default ({ proxyManager, remote }) => ({
           remote.session.subscribe('streams.stdout', (stdout) =>
             commit('appendStdout', stdout)
           );
+          // progress is published to every client, keep our job's only
+          remote.session.subscribe('jobs.progress', (progress) => {
+            if (progress.jobId === state.jobId) {
+              commit('setJobProgress', progress);
+            }
+          });
         })
         .catch((error) => commit('connectError', error));
     },
-    fetchParamList({ commit }) {
-      return remote.call('get_parameters').then((params) => {
+    fetchAlgorithmList({ commit }) {
+      return remote
+        .call('list_algorithms')
+        .then((algorithms) => commit('loadAlgorithms', algorithms));
+    },
+    selectAlgorithm({ commit, dispatch }, name) {
+      commit('selectAlgorithm', name);
+      return dispatch('fetchParamList');
+    },
+    fetchParamList({ state, commit }) {
+      return remote.call('get_parameters', state.algorithm).then((params) => {
         commit(
           'loadParams',
           params.map((param) => ({
@@ -76,26 +115,83 @@ export default ({ proxyManager, remote }) => ({
         );
       });
     },
-    runRemoteAlgorithm({ state, commit }) {
-      const args = {};
-      state.paramOrder.forEach((name) => {
-        args[name] = state.params[name].value;
-        if (state.params[name].type === 'source') {
-          const source = proxyManager.getProxyById(args[name]);
-          if (source) {
-            // replace value with actual dataset
-            args[name] = source.getDataset();
-          } else {
-            args[name] = null;
+    runRemoteAlgorithm({ state, commit }, { onPartialResult } = {}) {
+      // Sources are sent as dataset references. The server caches uploaded
+      // datasets by content hash, so unchanged sources are only uploaded once.
+      const prepareSource = (dataset, forceUpload) =>
+        hashDataset(dataset).then((uid) => {
+          if (!uid) {
+            return dataset;
           }
-        }
-      });
+          const isCached = forceUpload
+            ? Promise.resolve(false)
+            : remote.call('has_dataset', uid);
+          return isCached.then((cached) => ({
+            classType: 'DatasetRef',
+            uid,
+            data: cached ? null : dataset,
+          }));
+        });
+
+      const prepareArgs = (forceUpload) => {
+        const args = {};
+        const sources = [];
+        state.paramOrder.forEach((name) => {
+          args[name] = state.params[name].value;
+          if (state.params[name].type === 'source') {
+            const source = proxyManager.getProxyById(args[name]);
+            if (source) {
+              // replace value with actual dataset
+              sources.push(
+                prepareSource(source.getDataset(), forceUpload).then(
+                  (value) => {
+                    args[name] = value;
+                  }
+                )
+              );
+            } else {
+              args[name] = null;
+            }
+          }
+        });
+        return Promise.all(sources).then(() => args);
+      };
+
+      // previews published while the algorithm runs
+      const removePartialCallback = onPartialResult
+        ? remote.onPartialResult(onPartialResult)
+        : () => {};
+      // the job can be cancelled as soon as the server accepts it
+      const removeDeferredCallback = remote.onDeferredCall((jobId) =>
+        commit('setJobId', jobId)
+      );
 
       commit('processing', true);
-      const promise = remote.call('run', args);
-      promise.finally(() => commit('processing', false));
+      const promise = prepareArgs(false)
+        .then((args) => remote.call('run', args, state.algorithm))
+        .catch((error) => {
+          // a referenced dataset may have been evicted since has_dataset
+          const message = (error && error.data && error.data.exception) || '';
+          if (message.indexOf('is not cached on the server') > -1) {
+            return prepareArgs(true).then((args) =>
+              remote.call('run', args, state.algorithm)
+            );
+          }
+          throw error;
+        });
+      promise.finally(() => {
+        removePartialCallback();
+        removeDeferredCallback();
+        commit('processing', false);
+      });
       return promise;
     },
+    cancelRemoteAlgorithm({ state }) {
+      if (state.jobId) {
+        return remote.call('cancel_job', state.jobId);
+      }
+      return Promise.resolve(false);
+    },
     setParameter: wrapMutationAsAction('setParameter'),
     clearStdout: wrapMutationAsAction('clearStdout'),
   },